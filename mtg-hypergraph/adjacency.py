@@ -1,94 +1,323 @@
 import numpy as np
+import hashlib
 import json
 import os
-import networkx as nx
-import matplotlib
-matplotlib.use('Qt4Agg')
-import matplotlib.pyplot as plt
 import scipy as sp
-import scipy.stats
-from fetch import ml_tournament
+import scipy.sparse
+from cache import file_hash, matrix_key, load_array, save_array, load_arrays, save_arrays
+from storage import dataset_path, read_records, read_records_after
+from corpus import encode_tournaments, tournament_corpus, win_counts, format_mask
+from hypergraph import Hypergraph
+import instrument
 
 DATA_REPO = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + '/data/'
+#card keys already loaded, by key file stamp (or data file hash when there is no key file yet)
+_card_keys = dict()
+
+
+def unified():
+    """
+    Whether there is a unified, format-tagged dataset (see storage.merge_tournaments). Once there
+    is, every mtg_format combination shares its single card key and is computed from it.
+    """
+    return os.path.isfile(dataset_path(DATA_REPO + 'tournament_data'))
+
+
+def source_path(mtg_format=['constructed', 'limited']):
+    if unified():
+        return dataset_path(DATA_REPO + 'tournament_data')
+    return dataset_path(DATA_REPO + 'tournament_data_' + '_'.join(mtg_format))
+
+
+def card_key_path(mtg_format=['constructed', 'limited']):
+    if unified():
+        return DATA_REPO + 'card_key.json'
+    return DATA_REPO + 'card_key_' + '_'.join(mtg_format) + '.json'
+
+
+def extend_card_key(card_dict, t_data):
+    """
+    Appends cards not yet in card_dict in order of first appearance. Existing IDs never change,
+    so matrices built against an older key stay valid after it grows.
+    """
+    for tournament in t_data:
+        for entry in tournament['entries']:
+            for card in entry['deck']:
+                card_dict.setdefault(card.partition(' ')[2], len(card_dict))
+    return card_dict
 
 
 def card_key(mtg_format=['constructed', 'limited'], output=False):
-    data_path = DATA_REPO + 'tournament_data_' + '_'.join(mtg_format) + '.json'
-    key_path = DATA_REPO + 'card_key_' + '_'.join(mtg_format) + '.json'
-    if os.path.isfile(key_path) and not output:
-        with open(key_path) as key_file:
-            card_dict = json.load(key_file)
-            return card_dict
+    """
+    Card name -> card ID for mtg_format. A key file is only ever appended to: when the tournament data
+    has changed since the key was last brought up to date with it (as recorded next to it, in
+    card_key*.source.json) the new cards are added and both are written again. With output set the key
+    file is rebuilt from all of the data. Keys are remembered until their sources change; each caller
+    gets a copy.
+    """
+    data_path = source_path(mtg_format)
+    key_path = card_key_path(mtg_format)
+    source_file = key_path[:-len('.json')] + '.source.json'
     if not os.path.isfile(data_path):
+        if os.path.isfile(key_path) and not output:
+            stat = os.stat(key_path)
+            stamp = (key_path, stat.st_size, stat.st_mtime_ns)
+            if stamp not in _card_keys:
+                with open(key_path) as key_file:
+                    _card_keys[stamp] = json.load(key_file)
+            return dict(_card_keys[stamp])
+        #the scraper (requests, lxml) is only loaded when there is something to scrape
+        from fetch import ml_tournament
         ml_tournament(mtg_format=mtg_format)
-    with open(data_path) as file:
-        data = json.load(file)
-    card_set = set(' '.join(card.split(' ')[1:]) for tournament in data
-                   for entry in tournament['entries'] for card in entry['deck'])
-    card_dict = {card: index for index, card in enumerate(card_set)}
-    if output:
+
+    def stamp():
+        if not os.path.isfile(key_path):
+            return (key_path, file_hash(data_path))
+        stat = os.stat(key_path)
+        return (key_path, stat.st_size, stat.st_mtime_ns, file_hash(data_path))
+    if stamp() in _card_keys and not output:
+        return dict(_card_keys[stamp()])
+    card_dict, source = dict(), dict()
+    #a rebuilt key only ever appends to the existing one
+    if os.path.isfile(key_path):
+        with open(key_path) as key_file:
+            card_dict = json.load(key_file)
+        if os.path.isfile(source_file) and not output:
+            with open(source_file) as file:
+                source = json.load(file)
+    data_hash = file_hash(data_path)
+    if source.get('hash') != data_hash:
+        size = len(card_dict)
+        offset, marker = None, None
+        if data_path.endswith('.jsonl'):
+            #only what was appended since the key was last brought up to date has to be read
+            if source.get('source') == data_path and source.get('offset') is not None:
+                offset, marker = source['offset'], source['marker']
+            data, offset, marker = read_records_after(data_path, offset=offset or 0, marker=marker or '')
+        else:
+            data = read_records(data_path)
+        card_dict = extend_card_key(card_dict, data)
+        if output or os.path.isfile(key_path):
+            #the key is written before the record of what it covers, so a crash can only leave it ahead
+            if output or len(card_dict) > size:
+                with open(key_path, 'w') as writefile:
+                    json.dump(card_dict, writefile, indent=4, sort_keys=True, separators=(',', ': '))
+            with open(source_file, 'w') as writefile:
+                json.dump(dict(source=data_path, hash=data_hash, offset=offset, marker=marker), writefile,
+                          indent=4, sort_keys=True, separators=(',', ': '))
+    _card_keys[stamp()] = card_dict
+    if not output:
+        return dict(card_dict)
+
+
+def key_digest(card_dict, size=None):
+    """
+    sha1 of the first size cards of card_dict (all of them by default) in ID order. Keys only ever
+    grow, so counts built against a key still match any later version of it on their own size.
+    """
+    names = [None]*len(card_dict)
+    for card, index in card_dict.items():
+        names[index] = card
+    return hashlib.sha1(json.dumps(names[:size]).encode()).hexdigest()
+
+
+def key_card(mtg_format=['constructed', 'limited'], card_dict=None):
+    card_dict = card_key(mtg_format=mtg_format) if card_dict is None else card_dict
+    return {str(index): card for card, index in card_dict.items()}
+
+
+def sparse_matrix(t_data, card_dict, ignore_count=False):
+    """
+    Raw card vs. opponent card win counts of t_data as a sparse (CSR) matrix.
+    """
+    with instrument.stage('parse'):
+        corpus, _ = encode_tournaments(t_data, card_dict)
+    return win_counts(corpus, len(card_dict), ignore_count=ignore_count)
+
+
+#a higher (lower) norm makes the ranking more (less) favorable to popular cards
+def proportion_matrix(counts, norm=0.1):
+    """
+    Turns raw counts from matrix into (norm/2 + A_ij)/(norm + A_ij + A_ji) for the lower triangle and
+    one minus that for the upper one, with pairs whose denominator is zero set to 0.
+    Takes a dense or sparse matrix, so the counts can be re-normalized without rebuilding them.
+    """
+    if sp.sparse.issparse(counts):
+        counts = counts.toarray()
+    counts = np.asarray(counts, dtype=float)
+    with instrument.stage('normalize', cards=len(counts), norm=norm):
+        #same operation order as the scalar (norm + A_ij) + A_ji so the output is bit-identical
+        totals = counts + norm
+        totals += counts.T
+        lower = counts + norm/2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lower /= totals
+        adjacency = 1 - lower.T
+        np.copyto(adjacency, lower, where=np.tri(len(counts), k=-1, dtype=bool))
+        empty = totals == 0
+        adjacency[empty | empty.T] = 0
+    return adjacency
+
+
+def ingest(t_data=None, mtg_format=['constructed', 'limited'], ignore_count=False):
+    """
+    Adds tournaments that haven't been ingested yet to the persisted raw counts and returns them.
+    The counts are stored together with the IDs of every tournament already in them, so only the
+    new tournaments are kept in memory and counted, and the card key is only appended to.
+    t_data defaults to the tournament data file; pass freshly scraped tournaments to skip reading it.
+    For a plain .jsonl file the byte offset read up to is stored too, and only what was appended
+    after it is read next time. Stored counts built against another card key (as after
+    storage.merge_tournaments switches to the unified one) are thrown away and counted again.
+    """
+    key_path = card_key_path(mtg_format)
+    counts_path = DATA_REPO + 'counts' + '_'.join([ignore_count*'ignore_count'] + mtg_format) + '.npz'
+    data_path = source_path(mtg_format)
+    card_dict = dict()
+    if os.path.isfile(key_path):
+        with open(key_path) as key_file:
+            card_dict = json.load(key_file)
+    counts, ingested = sp.sparse.csr_matrix((0, 0)), list()
+    offset, marker = 0, ''
+    if os.path.isfile(counts_path):
+        with np.load(counts_path) as stored:
+            size = int(stored['shape'][0])
+            #the card IDs in the counts only mean something under the key they were counted with
+            if ('key' in stored.files and str(stored['key']) == key_path and size <= len(card_dict) and
+                    str(stored['key_digest']) == key_digest(card_dict, size)):
+                counts = sp.sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']),
+                                              shape=tuple(stored['shape']))
+                ingested = stored['ingested'].tolist()
+                if str(stored['source']) == data_path:
+                    offset, marker = int(stored['offset']), str(stored['marker'])
+    new_offset, new_marker = offset, marker
+    if t_data is None:
+        if data_path.endswith('.jsonl') and os.path.isfile(data_path):
+            t_data, new_offset, new_marker = read_records_after(data_path, offset=offset, marker=marker)
+        else:
+            t_data = read_records(data_path)
+    key_size = len(card_dict)
+    if unified():
+        def tagged(t_data):
+            for tournament in t_data:
+                #the key is shared by every format, so it takes in the cards of all of them
+                extend_card_key(card_dict, [tournament])
+                if tournament.get('format') in mtg_format:
+                    yield tournament
+        t_data = tagged(t_data)
+    seen = set(ingested)
+    new_data = [tournament for tournament in t_data if str(tournament['id']) not in seen]
+    instrument.event('ingest', mtg_format=mtg_format, ingested=len(ingested), new=len(new_data))
+    if not new_data and (new_offset, new_marker) == (offset, marker) and len(card_dict) == key_size:
+        counts.resize((len(card_dict), len(card_dict)))
+        return counts
+    card_dict = extend_card_key(card_dict, new_data)
+    #the key is written first: extra cards are harmless, while counts without their cards are not
+    if len(card_dict) > key_size:
         with open(key_path, 'w') as writefile:
             json.dump(card_dict, writefile, indent=4, sort_keys=True, separators=(',', ': '))
-    else:
-        return card_dict
+    counts.resize((len(card_dict), len(card_dict)))
+    if new_data:
+        counts = (counts + sparse_matrix(new_data, card_dict, ignore_count=ignore_count)).tocsr()
+        ingested += [str(tournament['id']) for tournament in new_data]
+    tmp_path = counts_path[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp_path, data=counts.data, indices=counts.indices, indptr=counts.indptr,
+             shape=np.array(counts.shape), ingested=np.array(ingested), source=np.array(data_path),
+             offset=np.array(new_offset), marker=np.array(new_marker), key=np.array(key_path),
+             key_digest=np.array(key_digest(card_dict, counts.shape[0])))
+    os.replace(tmp_path, counts_path)
+    return counts
 
 
-def key_card(mtg_format=['constructed', 'limited']):
-    return {str(index): card for card, index in card_key(mtg_format=mtg_format).items()}
+def format_counts(mtg_format, card_dict, ignore_count=False, cache=True):
+    """
+    Raw counts of the tournaments in the unified dataset tagged with any of mtg_format: the sum of
+    one partial matrix per format, each masked out of the shared corpus once and cached on its own.
+    """
+    data_path = source_path(mtg_format)
+    corpus = None
+    adjacency = sp.sparse.csr_matrix((len(card_dict), len(card_dict)))
+    for t_format in mtg_format:
+        key = matrix_key(data_path, card_dict, format=t_format, ignore_count=ignore_count)
+        partial = load_array(key, cache_dir=DATA_REPO + 'cache/') if cache else None
+        if partial is None:
+            if corpus is None:
+                corpus = tournament_corpus(data_path, card_dict, mtg_format=['all'], data_repo=DATA_REPO)
+                untagged = sum(not tag for tag in corpus['meta']['tournament_formats'])
+                if untagged:
+                    instrument.logger.warning('%d tournaments in %s have no format and are left out of every '
+                                              'matrix; tag them and merge again', untagged, data_path)
+            partial = win_counts(corpus, len(card_dict), ignore_count=ignore_count,
+                                 matchup_mask=format_mask(corpus, t_format))
+            if cache:
+                save_array(key, partial, cache_dir=DATA_REPO + 'cache/')
+        adjacency = adjacency + partial
+    return adjacency.tocsr()
 
 
-#a higher (lower) norm makes the ranking more (less) favorable to popular cards
 def matrix(mtg_format=['constructed', 'limited'], ignore_count=False,
-           output=False, proportion=False, norm=0.1, data_fmt='%u'):
-    tournament_path = DATA_REPO + 'tournament_data_' + '_'.join(mtg_format) + '.json'
+           output=False, proportion=False, norm=0.1, data_fmt='%u', dense=False, cache=True,
+           incremental=False):
+    """
+    Card vs. card adjacency. Raw counts are returned as a scipy.sparse CSR matrix unless dense is set;
+    proportions are (almost) never zero and so always come back as a dense array.
+    With cache set, every variant is stored under DATA_REPO/cache/, keyed on the contents of the
+    tournament data, and dense variants are memory-mapped back read only.
+    With incremental set, the raw counts come from ingest instead, so only new tournaments are counted.
+    """
+    tournament_path = source_path(mtg_format)
     matrix_path = DATA_REPO + 'adjacency' + '_'.join([ignore_count*'ignore_count',
                                                       proportion*'proportion'] + mtg_format) + '.txt'
-    with open(tournament_path) as file:
-        t_data = json.load(file)
-    card_dict = card_key(mtg_format=mtg_format)
-    adjacency = np.zeros((len(card_dict), len(card_dict)))
-    for tournament in t_data:
-        for matchup in tournament['matchups']:
-            if "Bye" in matchup:
-                continue
-            *players, record = matchup
-            decks = [entry['deck'] for player in players
-                     for entry in tournament['entries']
-                     if entry['player'] == player]
-            card_keys = [[card_dict[' '.join(card.split(' ')[1:])] for card in deck] for deck in decks]
-            card_counts = [[int(card.split(' ')[0]) for card in deck] for deck in decks]
-            if len(card_keys) + len(card_counts) != 4:
-                continue
-            try:
-                record = (int(record.split('-')[0]), int(record.split('-')[1]))
-            except AttributeError:
-                continue
-            for index in range(2):
-                if not record[index]:
-                    continue
-                for i, card_id in enumerate(card_keys[index]):
-                    for opp_card_id in card_keys[index-1]:
-                        if ignore_count:
-                            adjacency[card_id][opp_card_id] += record[index]
-                        else:
-                            adjacency[card_id][opp_card_id] += record[index]*card_counts[index][i]
+    if incremental:
+        adjacency = ingest(mtg_format=mtg_format, ignore_count=ignore_count)
+        if proportion:
+            adjacency = proportion_matrix(adjacency, norm=norm)
+    else:
+        card_dict = card_key(mtg_format=mtg_format)
+        key = matrix_key(tournament_path, card_dict, mtg_format=mtg_format, ignore_count=ignore_count,
+                         proportion=proportion, norm=norm)
+        adjacency = load_array(key, cache_dir=DATA_REPO + 'cache/') if cache else None
+        instrument.event('cache', name='matrix', hit=adjacency is not None, mtg_format=mtg_format,
+                         ignore_count=ignore_count, proportion=proportion)
+        if adjacency is None:
+            if unified():
+                adjacency = format_counts(mtg_format, card_dict, ignore_count=ignore_count, cache=cache)
+            else:
+                corpus = tournament_corpus(tournament_path, card_dict, mtg_format=mtg_format, data_repo=DATA_REPO)
+                adjacency = win_counts(corpus, len(card_dict), ignore_count=ignore_count)
+            if proportion:
+                adjacency = proportion_matrix(adjacency, norm=norm)
+            if cache:
+                save_array(key, adjacency, cache_dir=DATA_REPO + 'cache/')
     if proportion:
         data_fmt = '%.3f'
-        for i in range(len(card_dict)):
-            for j in range(len(card_dict)):
-                if j <= i:
-                    try:
-                        adjacency[i][j] = (norm/2 + float(adjacency[i][j]))/(norm + adjacency[i][j] + adjacency[j][i])
-                        adjacency[j][i] = 1 - adjacency[i][j]
-                    except (ValueError, ZeroDivisionError):
-                        adjacency[i][j], adjacency[j][i] = 0, 0
+    elif dense or output:
+        adjacency = adjacency.toarray()
     if output:
         np.savetxt(matrix_path, adjacency, fmt=data_fmt)
     else:
         return adjacency
 
 
+def deck_hypergraph(mtg_format=['constructed', 'limited'], minhash=True):
+    """
+    Deck-level hypergraph (see hypergraph.Hypergraph) of the tournaments of mtg_format, over the
+    same card IDs as card_key. With minhash set, the LSH index for nearest deck queries is built too.
+    """
+    card_dict = card_key(mtg_format=mtg_format)
+    data_path = source_path(mtg_format)
+    if unified():
+        corpus = tournament_corpus(data_path, card_dict, mtg_format=['all'], data_repo=DATA_REPO)
+        tagged = np.array([tag in mtg_format for tag in corpus['meta']['tournament_formats']], dtype=bool)
+        deck_mask = tagged[np.asarray(corpus['deck_tournament'])] if len(tagged) else None
+        graph = Hypergraph.from_corpus(corpus, len(card_dict), deck_mask=deck_mask)
+    else:
+        corpus = tournament_corpus(data_path, card_dict, mtg_format=mtg_format, data_repo=DATA_REPO)
+        graph = Hypergraph.from_corpus(corpus, len(card_dict))
+    return graph.minhash_index() if minhash else graph
+
+
 def mean_confidence_interval(data, confidence=0.95):
+    import scipy.stats
     a = 1.0*np.array(data)
     n = len(a)
     m, se = np.mean(a), scipy.stats.sem(a)
@@ -96,51 +325,188 @@ def mean_confidence_interval(data, confidence=0.95):
     return m, m-h, m+h
 
 
+def row_confidence_intervals(card_matrix, confidence=0.95):
+    """
+    mean_confidence_interval of every row of card_matrix at once, as an (n_rows, 3) array.
+    """
+    import scipy.stats
+    a = np.asarray(card_matrix, dtype=float)
+    n = a.shape[1]
+    m, se = a.mean(axis=1), a.std(axis=1, ddof=1)/np.sqrt(n)
+    h = se * sp.stats.t.ppf((1+confidence)/2., n-1)
+    return np.column_stack([m, m-h, m+h])
+
+
+def bernoulli_confidence_interval(wins, losses, confidence=0.95):
+    """
+    mean_confidence_interval of a sample of `wins` ones and `losses` zeros in closed form,
+    for whole arrays of win/loss counts at once. Returns the means, lower and upper bounds.
+    """
+    import scipy.stats
+    wins, losses = np.asarray(wins, dtype=float), np.asarray(losses, dtype=float)
+    n = wins + losses
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = wins/n
+        #the sample variance (ddof=1) of such a sample is wins*losses/(n*(n-1))
+        se = np.sqrt(wins*losses/(n*(n-1))/n)
+        h = se * sp.stats.t.ppf((1+confidence)/2., n-1)
+    return m, m-h, m+h
+
+
+def top_k(values, k, reverse=True):
+    """
+    Indices of the k largest (smallest unless reverse) values in order, ties in index order and
+    NaNs last, like a stable sort would give. Only the values that can make the cut get sorted.
+    """
+    keys = -np.asarray(values, dtype=float) if reverse else np.array(values, dtype=float)
+    keys[np.isnan(keys)] = np.inf
+    k = min(k, len(keys))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(keys):
+        #everything tied with the k-th value is kept so ties are still broken by index
+        kth = keys[np.argpartition(keys, k-1)[k-1]]
+        candidates = np.flatnonzero(keys <= kth)
+    else:
+        candidates = np.arange(len(keys))
+    return candidates[np.lexsort((candidates, keys[candidates]))][:k]
+
+
+def grouped_top_k(values, groups, k, reverse=True):
+    """
+    top_k within every group at once: positions of the k largest (smallest unless reverse) values
+    of each group, ordered by group and then as top_k orders them. groups must be sorted.
+    """
+    keys = -np.asarray(values, dtype=float) if reverse else np.array(values, dtype=float)
+    keys[np.isnan(keys)] = np.inf
+    groups = np.asarray(groups)
+    order = np.lexsort((np.arange(len(keys)), keys, groups))
+    rank = np.arange(len(order)) - np.searchsorted(groups, groups[order])
+    return order[rank < k]
+
+
+RANKING_ARRAYS = ['card_ints', 'pair_indptr', 'pair_rows', 'pair_cols', 'pair_ints', 'against_indptr', 'against_pairs']
+
+
+def ranking_index(mtg_format=['constructed', 'limited'], ignore_count=False, proportion=True, norm=0.1,
+                  cache=True, incremental=False, card_dict=None):
+    """
+    The confidence intervals behind every ranking query on one matrix variant, built once and
+    cached (and memory-mapped back) alongside the matrices:
+        card_ints: best_cards' interval for every row of the (proportion) matrix, (n_cards, 3)
+        pair_*: the interval of card i against card j for every pair in which i lost at least once,
+            as CSR arrays with one row per i (pair_rows holds i for every pair)
+        against_*: the same pairs grouped by j, as CSR offsets into the pair arrays
+    Callers that already hold the card key of mtg_format can pass it as card_dict.
+    """
+    card_dict = card_key(mtg_format=mtg_format) if card_dict is None else card_dict
+    tournament_path = source_path(mtg_format)
+    cache = cache and not incremental
+    if cache:
+        key = matrix_key(tournament_path, card_dict, mtg_format=mtg_format, ignore_count=ignore_count,
+                         proportion=proportion, norm=norm, ranking=True)
+        index = load_arrays(key, RANKING_ARRAYS, cache_dir=DATA_REPO + 'cache/')
+        instrument.event('cache', name='ranking_index', hit=index is not None, mtg_format=mtg_format,
+                         ignore_count=ignore_count, proportion=proportion)
+        if index is not None:
+            return index
+    card_matrix = matrix(mtg_format=mtg_format, ignore_count=ignore_count, proportion=proportion, norm=norm,
+                         dense=True, incremental=incremental)
+    counts = matrix(mtg_format=mtg_format, ignore_count=ignore_count, incremental=incremental)
+    #only pairs where i lost at least once can have an interval other than (1.0, 1.0, 1.0)
+    with instrument.stage('confidence_intervals', cards=counts.shape[0], pairs=counts.nnz):
+        losses = counts.T.tocsr()
+        losses.sort_indices()
+        rows = np.repeat(np.arange(losses.shape[0]), np.diff(losses.indptr))
+        wins = np.asarray(counts[rows, losses.indices]).ravel()
+        against_pairs = np.argsort(losses.indices, kind='stable')
+        index = dict(card_ints=row_confidence_intervals(card_matrix),
+                     pair_indptr=losses.indptr, pair_rows=rows, pair_cols=losses.indices,
+                     pair_ints=np.column_stack(bernoulli_confidence_interval(wins, losses.data)),
+                     against_indptr=np.concatenate([[0], np.cumsum(np.bincount(losses.indices,
+                                                                               minlength=losses.shape[1]))]),
+                     against_pairs=against_pairs)
+    if cache:
+        save_arrays(key, index, cache_dir=DATA_REPO + 'cache/')
+    return index
+
+
 def best_cards(mtg_format=['constructed', 'limited'], ignore_count=False, display_names=True,
-               proportion=True, verbose=True, worst=False, top_x=20):
-    key_card_dict = key_card(mtg_format=mtg_format)
-    card_matrix = matrix(mtg_format=mtg_format, ignore_count=ignore_count, proportion=proportion)
-    #average values over rows and sort. We only want non-zero values.
-    conf_ints = np.apply_along_axis(mean_confidence_interval, axis=1, arr=card_matrix)
+               proportion=True, verbose=True, worst=False, top_x=20, incremental=False):
+    card_dict = card_key(mtg_format=mtg_format)
+    index = ranking_index(mtg_format=mtg_format, ignore_count=ignore_count, proportion=proportion,
+                          incremental=incremental, card_dict=card_dict)
+    key_card_dict = key_card(card_dict=card_dict)
+    conf_ints = index['card_ints']
+    #the top_x rows by mean, in descending order unless we want the worst cards
+    top_rows = top_k(conf_ints[:, 0], top_x, reverse=not worst)
     if display_names:
-        card_conf_ints = [(key_card_dict[str(card_index)], conf_int) for card_index, conf_int in enumerate(conf_ints)]
+        sorted_conf_ints = [(key_card_dict[str(card_index)], np.array(conf_ints[card_index])) for card_index in top_rows]
     else:
-        card_conf_ints = [(card_index, conf_int) for card_index, conf_int in enumerate(conf_ints)]
-    #sort in descending order by mean
-    sorted_conf_ints = sorted(card_conf_ints, key=lambda x: x[1][0], reverse=not worst)[:top_x]
+        sorted_conf_ints = [(int(card_index), np.array(conf_ints[card_index])) for card_index in top_rows]
     if verbose:
         print(sorted_conf_ints)
     return sorted_conf_ints
 
 
-def best_cards_against(card_name, mtg_format=['constructed', 'limited'], top_x=30):
+def best_cards_against(card_name, mtg_format=['constructed', 'limited'], top_x=30, verbose=True):
+    """
+    The top_x cards with the best lower bound against card_name. For many lookups use
+    query.CardQuery, which loads everything once and answers whole batches.
+    """
     card_to_key = card_key(mtg_format=mtg_format)
-    key_to_card = key_card(mtg_format=mtg_format)
-    card_matrix = matrix(mtg_format=mtg_format, ignore_count=True)
+    key_to_card = key_card(card_dict=card_to_key)
+    index = ranking_index(mtg_format=mtg_format, ignore_count=True, card_dict=card_to_key)
     card_id = card_to_key[card_name]
-    success_loss_array = [(index, [1]*card_matrix[index, card_id] + [0]*card_matrix[card_id, index])
-                          for index in range(len(card_matrix[card_id]))
-                          if card_matrix[card_id, index] + card_matrix[index, card_id]]
-    #creates 95% confidence intervals and filters out (1.0, 1.0, 1.0) results
-    conf_ints = [(key_to_card[str(matchup[0])], mean_confidence_interval(matchup[1]))
-                 for matchup in success_loss_array if not all(int_val == 1.0 for int_val in matchup[1])]
-    sorted_conf_ints = sorted(conf_ints, key=lambda x: x[1][1], reverse=True)[:top_x]
-    print(sorted_conf_ints)
-
-
-def digraph_best_cards(mtg_format=['constructed', 'limited'], top_x=2):
-    card_matrix = matrix(mtg_format=mtg_format, ignore_count=False)
-    success_loss_array = [[(i, j, [1]*card_matrix[i, j] + [0]*card_matrix[j, i]) for j in range(len(card_matrix))]
-                          for i in range(len(card_matrix))]
-    conf_ints = [sorted([(matchup[0], matchup[1], mean_confidence_interval(matchup[2])[1]) for matchup in row
-                 if not all(int_val == 1.0 for int_val in matchup[2])], key=lambda x: x[2], reverse=True)[:top_x]
-                 for row in success_loss_array]
-    top_vals = [top_val for top_list in conf_ints for top_val in top_list if top_val[2] > 0.0]
+    #every card that lost to card_name at least once, with its 95% confidence interval
+    pairs = index['against_pairs'][index['against_indptr'][card_id]:index['against_indptr'][card_id+1]]
+    conf_ints = index['pair_ints'][pairs]
+    sorted_conf_ints = [(key_to_card[str(index['pair_rows'][pairs[i]])], tuple(conf_ints[i]))
+                        for i in top_k(conf_ints[:, 1], top_x)]
+    if verbose:
+        print(sorted_conf_ints)
+    return sorted_conf_ints
+
+
+def pyplot():
+    """
+    matplotlib.pyplot on the non-interactive Agg backend, imported on first use so nothing above
+    needs matplotlib or a display. Figures are saved to image files rather than shown.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def digraph_best_cards(mtg_format=['constructed', 'limited'], top_x=2, output=True):
+    """
+    Directed graph of every card to its top_x best matchups whose lower bound is positive. With output
+    set it is drawn to DATA_REPO/digraph_best_cards_*.png (or to output, if it is a path); otherwise the
+    networkx DiGraph is returned.
+    """
+    import networkx as nx
+    index = ranking_index(mtg_format=mtg_format, ignore_count=False)
+    rows, cols, lower = index['pair_rows'], index['pair_cols'], index['pair_ints'][:, 1]
+    #best lower bounds first within each row, ties in column order
+    order = np.lexsort((cols, -lower, rows))
+    rows, cols, lower = rows[order], cols[order], lower[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = (rank < top_x) & (lower > 0.0)
+    top_vals = list(zip(rows[keep].tolist(), cols[keep].tolist(), lower[keep].tolist()))
     print(top_vals)
     DG = nx.DiGraph()
     DG.add_weighted_edges_from(top_vals)
-    nx.draw(DG)
-    plt.show()
+    if output:
+        write_path = output if isinstance(output, str) else (DATA_REPO + 'digraph_best_cards_' +
+                                                             '_'.join(mtg_format) + '.png')
+        plt = pyplot()
+        figure = plt.figure()
+        nx.draw(DG, ax=figure.gca())
+        figure.savefig(write_path)
+        plt.close(figure)
+    else:
+        return DG
 
 #scrape links like:
 #http://archive.wizards.com/Magic/digital/magiconlinetourn.aspx?x=mtg/digital/magiconline/tourn/6800345
@@ -148,7 +514,7 @@ def digraph_best_cards(mtg_format=['constructed', 'limited'], top_x=2):
 
 if __name__ == '__main__':
     card_key(output=True)
-    import pylab as P
+    P = plt = pyplot()
 
     def _blob(x, y, area, color):
         """
@@ -201,7 +567,7 @@ if __name__ == '__main__':
                     _blob(_x - 0.5, height - _y + 0.5, min(1, -w/max_weight), 'black')
         if reenable:
             P.ion()
-        P.show()
+        P.savefig(DATA_REPO + 'hinton_best_worst.png')
     print(names)
     card_matrix = matrix(mtg_format=['constructed', 'limited'], ignore_count=False, proportion=True)
     card_matrix = card_matrix[:, worst_cards][cards]
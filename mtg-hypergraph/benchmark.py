@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import scipy
+import adjacency
+import fetch
+import synthetic
+
+DATA_REPO = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + '/data/'
+#scale points, each a set of synthetic.generate arguments
+SCALES = {
+    'small': dict(n_cards=300, n_tournaments=50, n_players=16, n_scg_decks=1000),
+    'medium': dict(n_cards=1000, n_tournaments=200, n_players=32, n_scg_decks=4000),
+    'large': dict(n_cards=3000, n_tournaments=800, n_players=64, n_scg_decks=16000),
+}
+MTG_FORMAT = ['constructed', 'limited']
+
+
+def stages(data_repo, mtg_format=MTG_FORMAT):
+    """
+    (name, function, what its throughput is counted in) for every benchmarked stage, in the order
+    they run. Later stages reuse whatever the earlier ones cached, as they would in real use.
+    """
+    deck_data = data_repo + 'scg9272814.jsonl'
+
+    def against():
+        card_dict = adjacency.card_key(mtg_format=mtg_format)
+        adjacency.best_cards_against(min(card_dict, key=card_dict.get), mtg_format=mtg_format)
+    return [
+        ('card_key', lambda: adjacency.card_key(mtg_format=mtg_format, output=True), 'n_tournaments'),
+        ('matrix', lambda: adjacency.matrix(mtg_format=mtg_format), 'n_tournaments'),
+        ('matrix_proportion', lambda: adjacency.matrix(mtg_format=mtg_format, proportion=True), 'n_tournaments'),
+        ('best_cards', lambda: adjacency.best_cards(mtg_format=mtg_format, verbose=False), 'n_tournaments'),
+        ('best_cards_against', against, 'n_tournaments'),
+        ('digraph_best_cards', lambda: adjacency.digraph_best_cards(mtg_format=mtg_format), 'n_tournaments'),
+        ('scg_card_data', lambda: fetch.scg_card_data(deck_data=deck_data), 'n_scg_decks'),
+        ('scg_card_data_combo', lambda: fetch.scg_card_data(deck_data=deck_data, card_combo=2), 'n_scg_decks'),
+    ]
+
+
+def reset(data_repo, inputs):
+    """
+    Removes everything but the generated inputs from data_repo, so the next run starts cold.
+    """
+    for path in glob.glob(data_repo + '*'):
+        if path in inputs:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def timed(function):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    return time.perf_counter() - start
+
+
+def traced(function):
+    """
+    Peak bytes traced by tracemalloc while function ran; numpy reports its buffers to it too.
+    """
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    return tracemalloc.get_traced_memory()[1] - baseline
+
+
+def benchmark_scale(params, data_repo, repeat=3, mtg_format=MTG_FORMAT):
+    """
+    Times every stage on a fresh synthetic dataset generated with params: cold (caches emptied) and
+    warm (best of repeat runs with caches filled), then measures the peak memory of a second cold
+    pass under tracemalloc, which is kept apart since tracing slows everything down.
+    """
+    inputs = synthetic.generate(data_repo=data_repo, mtg_format=mtg_format, **params)
+    #every module reads its data from its own DATA_REPO
+    adjacency.DATA_REPO = fetch.DATA_REPO = data_repo
+    results = dict()
+    reset(data_repo, inputs)
+    for name, function, unit in stages(data_repo, mtg_format=mtg_format):
+        cold = timed(function)
+        warm = min(timed(function) for _ in range(repeat))
+        results[name] = dict(cold_seconds=cold, warm_seconds=warm, throughput_unit=unit.replace('n_', '') + '/s',
+                             cold_throughput=params[unit]/cold, warm_throughput=params[unit]/warm)
+    reset(data_repo, inputs)
+    tracemalloc.start()
+    try:
+        for name, function, _ in stages(data_repo, mtg_format=mtg_format):
+            results[name]['peak_bytes'] = traced(function)
+    finally:
+        tracemalloc.stop()
+    return dict(params, stages=results, max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def environment():
+    """
+    What the numbers were measured on, so results from different versions can be lined up.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(created=datetime.datetime.now().isoformat(timespec='seconds'), commit=commit,
+                python=platform.python_version(), numpy=np.__version__, scipy=scipy.__version__,
+                platform=platform.platform(), cpus=os.cpu_count())
+
+
+def run(scales=['small', 'medium'], repeat=3, output=True, data_repo=None):
+    """
+    Benchmarks every scale point in scales (names from SCALES, or generate argument dicts). With
+    output set, the results are written as JSON to DATA_REPO/benchmarks/ (or to output, if it is a
+    path) and the path is returned; otherwise the results are. Each scale point runs in a temporary
+    directory unless data_repo is given.
+    """
+    original = adjacency.DATA_REPO, fetch.DATA_REPO
+    results = dict(environment(), scales=list())
+    try:
+        for scale in scales:
+            params = SCALES[scale] if isinstance(scale, str) else scale
+            scale_repo = data_repo or tempfile.mkdtemp(prefix='mtg-benchmark-') + '/'
+            try:
+                results['scales'].append(dict(benchmark_scale(params, scale_repo, repeat=repeat),
+                                              scale=scale if isinstance(scale, str) else None))
+            finally:
+                if data_repo is None:
+                    shutil.rmtree(scale_repo, ignore_errors=True)
+    finally:
+        adjacency.DATA_REPO, fetch.DATA_REPO = original
+    if output:
+        write_path = output if isinstance(output, str) else (DATA_REPO + 'benchmarks/' +
+                                                             results['created'].replace(':', '') + '.json')
+        if not os.path.isdir(os.path.dirname(write_path)):
+            os.makedirs(os.path.dirname(write_path))
+        with open(write_path, 'w') as writefile:
+            json.dump(results, writefile, indent=4, sort_keys=True, separators=(',', ': '))
+        return write_path
+    else:
+        return results
+
+
+def scale_label(scale):
+    """
+    A scale point's name, or its generate arguments if it has none.
+    """
+    return scale['scale'] or json.dumps({k: v for k, v in scale.items() if k.startswith('n_') or k == 'rounds'},
+                                        sort_keys=True)
+
+
+def compare(baseline_path, results_path):
+    """
+    Ratio of results to baseline for every stage time and peak at each scale point both share;
+    above 1 is a regression.
+    """
+    with open(baseline_path) as file:
+        baseline = {scale_label(scale): scale['stages'] for scale in json.load(file)['scales']}
+    with open(results_path) as file:
+        results = {scale_label(scale): scale['stages'] for scale in json.load(file)['scales']}
+    ratios = dict()
+    for label, scale_stages in results.items():
+        old = baseline.get(label, dict())
+        ratios[label] = {name: {measure: stage[measure]/old[name][measure]
+                                for measure in ('cold_seconds', 'warm_seconds', 'peak_bytes')
+                                if old.get(name, dict()).get(measure)}
+                         for name, stage in scale_stages.items() if name in old}
+    return ratios
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the analytics stages on synthetic data.')
+    parser.add_argument('scales', nargs='*', default=['small', 'medium'], choices=sorted(SCALES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=True)
+    parser.add_argument('--compare', help='earlier results to compare the new ones with')
+    args = parser.parse_args()
+    path = run(scales=args.scales, repeat=args.repeat, output=args.output)
+    print(path)
+    if args.compare:
+        print(json.dumps(compare(args.compare, path), indent=4, sort_keys=True))
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+DATA_REPO = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + '/data/'
+CACHE_REPO = DATA_REPO + 'cache/'
+#total size the cache may grow to before the least recently used arrays are evicted
+MAX_BYTES = 2**30
+
+_file_hashes = dict()
+
+
+def file_hash(path, chunk_size=2**20):
+    """
+    sha1 of the file's contents, remembered for as long as its size and mtime don't change.
+    """
+    stat = os.stat(path)
+    stamp = (path, stat.st_size, stat.st_mtime_ns)
+    if stamp not in _file_hashes:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                digest.update(chunk)
+        _file_hashes[stamp] = digest.hexdigest()
+    return _file_hashes[stamp]
+
+
+def matrix_key(data_path, card_dict, **params):
+    """
+    Content address of a matrix variant: the source data, the card index it was built against
+    and the parameters it was built with. Any change to the tournament data gives a new key.
+    """
+    digest = hashlib.sha1(file_hash(data_path).encode())
+    digest.update(json.dumps(card_dict, sort_keys=True).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def load_array(key, cache_dir=CACHE_REPO):
+    """
+    Returns the cached array for key (dense arrays are memory-mapped read only) or None.
+    """
+    dense_path, sparse_path = cache_dir + key + '.npy', cache_dir + key + '.npz'
+    if os.path.isfile(dense_path):
+        os.utime(dense_path)
+        return np.load(dense_path, mmap_mode='r')
+    if os.path.isfile(sparse_path):
+        os.utime(sparse_path)
+        return sp.sparse.load_npz(sparse_path)
+
+
+def save_array(key, array, cache_dir=CACHE_REPO, max_bytes=MAX_BYTES):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    #write to a temporary file first so a crash never leaves a truncated entry behind
+    if sp.sparse.issparse(array):
+        path, tmp_path = cache_dir + key + '.npz', cache_dir + key + '.tmp.npz'
+        sp.sparse.save_npz(tmp_path, array.tocsr(), compressed=False)
+    else:
+        path, tmp_path = cache_dir + key + '.npy', cache_dir + key + '.tmp.npy'
+        np.save(tmp_path, np.asarray(array))
+    os.replace(tmp_path, path)
+    evict(cache_dir=cache_dir, max_bytes=max_bytes)
+
+
+def evict(cache_dir=CACHE_REPO, max_bytes=MAX_BYTES):
+    """
+    Removes the least recently used entries until the cache fits in max_bytes, always keeping the newest.
+    """
+    entries = [os.path.join(cache_dir, file) for file in os.listdir(cache_dir)
+               if file.endswith(('.npy', '.npz')) and '.tmp.' not in file]
+    entries = sorted(entries, key=os.path.getmtime)
+    total = sum(os.path.getsize(entry) for entry in entries)
+    for entry in entries[:-1]:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(entry)
+        os.remove(entry)
+
+
+def load_arrays(key, names, cache_dir=CACHE_REPO):
+    """
+    Returns the named arrays saved together by save_arrays as a dict, or None if any is missing.
+    """
+    arrays = {name: load_array(key + '.' + name, cache_dir=cache_dir) for name in names}
+    if all(array is not None for array in arrays.values()):
+        return arrays
+
+
+def save_arrays(key, arrays, cache_dir=CACHE_REPO, max_bytes=MAX_BYTES):
+    for name, array in arrays.items():
+        save_array(key + '.' + name, array, cache_dir=cache_dir, max_bytes=max_bytes)
@@ -0,0 +1,307 @@
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import os
+import numpy as np
+import scipy as sp
+import scipy.sparse
+from cache import matrix_key, file_hash
+from storage import read_records
+import instrument
+
+DATA_REPO = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + '/data/'
+
+
+def encode_tournaments(t_data, card_dict):
+    """
+    Integer encoding of tournament data. Deck d is cards[offsets[d]:offsets[d+1]] (one entry per
+    decklist line, so repeated lines stay repeated) with the matching counts, and was played in
+    tournament deck_tournament[d]. Each usable matchup is a row of matchups (deck A, deck B) and
+    wins (wins A, wins B); byes, unknown players and unreadable records are dropped here.
+    Returns the arrays and the ID and format tag (if any) of every tournament.
+    """
+    offsets, cards, counts, deck_tournament = [0], list(), list(), list()
+    matchups, wins, tournament_ids, tournament_formats = list(), list(), list(), list()
+    for tournament_index, tournament in enumerate(t_data):
+        tournament_ids.append(str(tournament['id']))
+        tournament_formats.append(tournament.get('format'))
+        #index every player's deck(s) once instead of scanning the entries for each matchup
+        player_decks = dict()
+        for entry in tournament['entries']:
+            player_decks.setdefault(entry['player'], list()).append(len(deck_tournament))
+            for card in entry['deck']:
+                count, _, name = card.partition(' ')
+                cards.append(card_dict[name])
+                counts.append(int(count))
+            offsets.append(len(cards))
+            deck_tournament.append(tournament_index)
+        for matchup in tournament['matchups']:
+            if "Bye" in matchup:
+                continue
+            *players, record = matchup
+            decks = [deck for player in players for deck in player_decks.get(player, ())]
+            if len(decks) != 2:
+                continue
+            try:
+                record = (int(record.split('-')[0]), int(record.split('-')[1]))
+            except AttributeError:
+                continue
+            matchups.append(decks)
+            wins.append(record)
+    return dict(offsets=np.array(offsets, dtype=np.int64), cards=np.array(cards, dtype=np.int32),
+                counts=np.array(counts, dtype=np.int16), deck_tournament=np.array(deck_tournament, dtype=np.int32),
+                matchups=np.array(matchups, dtype=np.int32).reshape(-1, 2),
+                wins=np.array(wins, dtype=np.int16).reshape(-1, 2)), \
+        dict(tournament_ids=tournament_ids, tournament_formats=tournament_formats)
+
+
+def encode_decks(decks):
+    """
+    Integer encoding of SCG deck data: the same deck layout as encode_tournaments plus the rank
+    of every deck. Returns the arrays and the card names in order of first appearance.
+    """
+    card_dict = dict()
+    offsets, cards, counts, ranks = [0], list(), list(), list()
+    for deck in decks:
+        for name, count in deck['card']['names']:
+            cards.append(card_dict.setdefault(name, len(card_dict)))
+            counts.append(count)
+        offsets.append(len(cards))
+        ranks.append(int(deck['rank']))
+    return dict(offsets=np.array(offsets, dtype=np.int64), cards=np.array(cards, dtype=np.int32),
+                counts=np.array(counts, dtype=np.int16), ranks=np.array(ranks, dtype=np.int32)), list(card_dict)
+
+
+def save(path, arrays, meta):
+    """
+    Writes every array as its own .npy file in the directory path. meta.json goes last and is
+    what marks the corpus as complete.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if os.path.isfile(path + 'meta.json'):
+        os.remove(path + 'meta.json')
+    for name, array in arrays.items():
+        np.save(path + name + '.npy', array)
+    with open(path + 'meta.json', 'w') as writefile:
+        json.dump(meta, writefile)
+
+
+def load(path, key=None):
+    """
+    Memory-maps the corpus in the directory path, or returns None if there is no complete corpus
+    there or it was built for a different key.
+    """
+    if not os.path.isfile(path + 'meta.json'):
+        return
+    with open(path + 'meta.json') as file:
+        meta = json.load(file)
+    if key is not None and meta.get('key') != key:
+        return
+    corpus = {name: np.load(path + name + '.npy', mmap_mode='r') for name in meta['arrays']}
+    corpus['meta'] = dict(meta, path=path)
+    return corpus
+
+
+def tournament_corpus(data_path, card_dict, mtg_format=['constructed', 'limited'], data_repo=DATA_REPO):
+    """
+    The corpus of the tournament data at data_path, encoded against card_dict. It is built once and
+    rebuilt only when the data or the card key change. mtg_format only names the directory it is
+    kept in; the unified dataset uses ['all'].
+    """
+    path = data_repo + 'corpus_' + '_'.join(mtg_format) + '/'
+    key = matrix_key(data_path, card_dict)
+    corpus = load(path, key=key)
+    if corpus is None:
+        with instrument.stage('parse', data=data_path) as stage:
+            arrays, meta = encode_tournaments(read_records(data_path), card_dict)
+            stage.set(tournaments=len(meta['tournament_ids']), decks=len(arrays['offsets']) - 1)
+        save(path, arrays, dict(meta, key=key, arrays=list(arrays)))
+        corpus = load(path, key=key)
+    return corpus
+
+
+def deck_corpus(deck_data, data_repo=DATA_REPO):
+    """
+    The corpus of the SCG deck data at deck_data, with the card names under meta['cards'].
+    """
+    name = os.path.basename(deck_data).split('.')[0]
+    path = data_repo + 'corpus_' + name + '/'
+    key = file_hash(deck_data)
+    corpus = load(path, key=key)
+    if corpus is None:
+        with instrument.stage('parse', data=deck_data) as stage:
+            arrays, names = encode_decks(read_records(deck_data))
+            stage.set(decks=len(arrays['offsets']) - 1)
+        save(path, arrays, dict(key=key, arrays=list(arrays), cards=names))
+        corpus = load(path, key=key)
+    return corpus
+
+
+def win_counts(corpus, n_cards, ignore_count=False, matchup_mask=None):
+    """
+    Raw card vs. opponent card win counts of a tournament corpus as a sparse (CSR) matrix.
+    Decks become rows of a deck by card matrix and wins a deck vs. deck matrix, so the adjacency
+    is the sum of the outer products w * d_i d_j^T over all matchups (or those in matchup_mask).
+    """
+    offsets, cards = np.asarray(corpus['offsets']), np.asarray(corpus['cards'])
+    n_decks = len(offsets) - 1
+    #every decklist line of the opponent counts once, our own lines count their quantity
+    listings = sp.sparse.csr_matrix((np.ones(len(cards)), cards, offsets), shape=(n_decks, n_cards))
+    if ignore_count:
+        decks = listings
+    else:
+        decks = sp.sparse.csr_matrix((np.asarray(corpus['counts'], dtype=float), cards, offsets),
+                                     shape=(n_decks, n_cards))
+    matchups, wins = np.asarray(corpus['matchups']), np.asarray(corpus['wins'])
+    if matchup_mask is not None:
+        matchups, wins = matchups[matchup_mask], wins[matchup_mask]
+    wins = sp.sparse.csr_matrix((np.concatenate([wins[:, 0], wins[:, 1]]).astype(float),
+                                 (np.concatenate([matchups[:, 0], matchups[:, 1]]),
+                                  np.concatenate([matchups[:, 1], matchups[:, 0]]))),
+                                shape=(n_decks, n_decks))
+    with instrument.stage('matrix_build', decks=n_decks, matchups=len(matchups), ignore_count=ignore_count):
+        return (decks.T @ (wins @ listings)).tocsr()
+
+
+def card_rank_stats(corpus):
+    """
+    Mean and standard deviation of the rank of the decks playing each card, every copy counting
+    once, and the number of copies played. Returns three arrays indexed by card ID.
+    """
+    offsets, cards = np.asarray(corpus['offsets']), np.asarray(corpus['cards'])
+    counts = np.asarray(corpus['counts'], dtype=float)
+    ranks = np.repeat(np.asarray(corpus['ranks'], dtype=float), np.diff(offsets))
+    n_cards = len(corpus['meta']['cards'])
+    plays = np.bincount(cards, weights=counts, minlength=n_cards)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(cards, weights=counts*ranks, minlength=n_cards)/plays
+        std = np.sqrt(np.bincount(cards, weights=counts*(ranks - mean[cards])**2, minlength=n_cards)/plays)
+    return mean, std, plays.astype(int)
+
+
+def _deck_combos(cards, size, survivors):
+    """
+    Position tuples of the size-card combinations of one deck, in itertools.combinations order,
+    leaving out any combination with a smaller subset that didn't survive the previous levels.
+    """
+    def extend(combo, start):
+        for position in range(start, len(cards)):
+            new_combo = combo + (position,)
+            ids = tuple(sorted(cards[i] for i in new_combo))
+            if len(new_combo) < size:
+                if ids in survivors[len(new_combo)]:
+                    yield from extend(new_combo, position + 1)
+            elif size == 1 or all(subset in survivors[size - 1]
+                                  for subset in itertools.combinations(ids, size - 1)):
+                yield new_combo
+    return extend((), 0)
+
+
+def _combo_chunk(corpus, start, stop, size, card_combo, survivors):
+    """
+    Accumulators for decks start to stop at one level of combo_rank_stats. Below card_combo that is
+    the copies played and the number of occurrences of each combination (as sorted card IDs); at
+    card_combo it is a running (copies, mean, M2) of the deck ranks, keyed like the decks list them.
+    """
+    if isinstance(corpus, str):
+        corpus = load(corpus)
+    offsets, all_cards, all_counts, ranks = corpus['offsets'], corpus['cards'], corpus['counts'], corpus['ranks']
+    stats = dict()
+    for deck in range(start, stop):
+        cards = all_cards[offsets[deck]:offsets[deck+1]].tolist()
+        counts = all_counts[offsets[deck]:offsets[deck+1]].tolist()
+        rank = float(ranks[deck])
+        for combo in _deck_combos(cards, size, survivors):
+            weight = sum(counts[i] for i in combo)
+            if size < card_combo:
+                totals = stats.setdefault(tuple(sorted(cards[i] for i in combo)), [0, 0])
+                totals[0] += weight
+                totals[1] += 1
+                continue
+            #weighted Welford update: the rank counts once for every copy of the cards in the combination
+            accumulator = stats.setdefault(tuple(cards[i] for i in combo), [0, 0.0, 0.0])
+            if weight:
+                accumulator[0] += weight
+                delta = rank - accumulator[1]
+                accumulator[1] += delta*weight/accumulator[0]
+                accumulator[2] += delta*(rank - accumulator[1])*weight
+    return stats
+
+
+def _merge(merged, stats):
+    for key, value in stats.items():
+        if key not in merged:
+            merged[key] = value
+        elif len(value) == 2:
+            merged[key][0] += value[0]
+            merged[key][1] += value[1]
+        elif value[0]:
+            #Chan et al.'s pairwise combination of two running variances
+            n_a, mean_a, m2_a = merged[key]
+            n = n_a + value[0]
+            delta = value[1] - mean_a
+            merged[key] = [n, mean_a + delta*value[0]/n, m2_a + value[2] + delta**2*n_a*value[0]/n]
+    return merged
+
+
+def combo_rank_stats(corpus, card_combo, min_plays=20, processes=None, chunks=None):
+    """
+    Mean and standard deviation of the deck rank, every copy of every card in the combination
+    counting once, and the number of copies, for each card_combo-card combination of a deck corpus
+    that is played at least min_plays times. Returns (card IDs as the decks list them, stats) pairs
+    in order of first appearance.
+    Levels are counted apriori-style: a smaller combination is dropped as soon as an upper bound on
+    the copies any combination containing it could reach falls below min_plays, and nothing
+    containing a dropped combination is enumerated again. With processes set, each level is split
+    over a process pool and the accumulators are merged afterwards.
+    """
+    offsets, cards = np.asarray(corpus['offsets']), np.asarray(corpus['cards'])
+    n_decks = len(offsets) - 1
+    max_count, max_listings = 0, 1
+    if len(cards):
+        max_count = int(np.max(corpus['counts']))
+        #the most times a single card is listed in one deck (main deck and sideboard, say)
+        deck_of_listing = np.repeat(np.arange(n_decks, dtype=np.int64), np.diff(offsets))
+        max_listings = int(np.unique(deck_of_listing*(int(cards.max()) + 1) + cards, return_counts=True)[1].max())
+    chunks = chunks or (4*processes if processes else 1)
+    bounds = np.linspace(0, n_decks, chunks + 1).astype(int)
+    starts, stops = bounds[:-1].tolist(), bounds[1:].tolist()
+    survivors = dict()
+    executor = ProcessPoolExecutor(max_workers=processes) if processes else None
+    try:
+        for size in range(1, card_combo + 1):
+            if executor:
+                results = executor.map(_combo_chunk, itertools.repeat(corpus['meta']['path']), starts, stops,
+                                       itertools.repeat(size), itertools.repeat(card_combo),
+                                       itertools.repeat(survivors))
+            else:
+                results = (_combo_chunk(corpus, start, stop, size, card_combo, survivors)
+                           for start, stop in zip(starts, stops))
+            merged = dict()
+            for stats in results:
+                merged = _merge(merged, stats)
+            if size < card_combo:
+                #each occurrence of a combination S extends to at most max_listings**remaining occurrences of
+                #a bigger one, each adding at most max_count copies per added card
+                remaining = card_combo - size
+                survivors[size] = {key for key, (plays, occurrences) in merged.items()
+                                   if max_listings**remaining*(plays + remaining*occurrences*max_count) >= min_plays}
+    finally:
+        if executor:
+            executor.shutdown()
+    card_data = list()
+    for key, (plays, mean, m2) in merged.items():
+        if plays >= min_plays:
+            card_data.append((key, (mean if plays else np.nan, np.sqrt(m2/plays) if plays else np.nan, plays)))
+    return card_data
+
+
+def format_mask(corpus, t_format):
+    """
+    Which matchups of a corpus were played in tournaments tagged t_format.
+    """
+    tagged = np.array([tag == t_format for tag in corpus['meta']['tournament_formats']], dtype=bool)
+    if not len(tagged):
+        return np.zeros(len(corpus['matchups']), dtype=bool)
+    return tagged[np.asarray(corpus['deck_tournament'])[np.asarray(corpus['matchups'])[:, 0]]]
@@ -1,12 +1,21 @@
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import gzip
+import hashlib
 import itertools
 import json
-from lxml import html
+import logging
+from lxml import etree, html
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import Timeout, ConnectionError
 import math
-import numpy as np
+import threading
+import time
+from urllib.parse import urlsplit
+from storage import dataset_path, read_records, write_records, convert
+from corpus import deck_corpus, card_rank_stats, combo_rank_stats
+import instrument
 
 DATA_REPO = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + '/data/'
 URL = 'http://www.mtggoldfish.com/tournament/'
@@ -14,41 +23,166 @@ ML_URL = 'http://www.magic-league.com/'
 SCG_URL = 'http://sales.starcitygames.com/deckdatabase/deckshow.php?&t%5BC1%5D=1'
 
 
-def tournaments(output=DATA_REPO + 'tournaments.json', verbose=True):
-    tourney_list = list()
-    add_tourney = tourney_list.append
+class Fetcher(object):
+    """
+    Pooled HTTP session shared by the scrapers. Caps the requests in flight and the request rate
+    per host, retries failed requests with exponential backoff and fans work out over a thread pool.
+    Every page fetched is kept gzipped in cache_dir, keyed by URL, and not requested again unless
+    asked to refresh it, as pages that still change (listings, unfinished tournaments) have to be;
+    with offline set nothing but the cache is read.
+    """
+    def __init__(self, max_workers=8, per_host=4, rate=5.0, retries=3, backoff=1.0, timeout=10,
+                 cache_dir=DATA_REPO + 'pages/', offline=False):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        #requests per second per host, None for no limit
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(max_workers, per_host))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._hosts = dict()
+
+    def _host(self, link):
+        host = urlsplit(link).netloc
+        with self._lock:
+            if host not in self._hosts:
+                #(concurrency limit, earliest time the next request may start)
+                self._hosts[host] = (threading.BoundedSemaphore(self.per_host), [0.0])
+            return self._hosts[host]
+
+    def _throttle(self, next_slot):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, next_slot[0])
+            next_slot[0] = start + 1/self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def cache_path(self, link):
+        return self.cache_dir + hashlib.sha1(link.encode()).hexdigest() + '.html.gz'
+
+    def get(self, link, refresh=False):
+        """
+        Returns the text of the page at link, or None once every retry has failed. With refresh set
+        the cached copy is skipped (unless offline) and replaced by the page as it is now.
+        """
+        start = time.perf_counter()
+        if self.cache_dir:
+            cache_path = self.cache_path(link)
+            if os.path.isfile(cache_path) and (self.offline or not refresh):
+                with gzip.open(cache_path, 'rt', encoding='utf-8') as file:
+                    text = file.read()
+                instrument.event('fetch', url=link, cache_hit=True, bytes=len(text),
+                                 seconds=time.perf_counter() - start)
+                return text
+        if self.offline:
+            instrument.event('fetch', url=link, cache_hit=False, failed=True, offline=True)
+            return
+        semaphore, next_slot = self._host(link)
+        status = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2**(attempt - 1))
+            with semaphore:
+                self._throttle(next_slot)
+                request_start = time.perf_counter()
+                try:
+                    response = self.session.get(link, timeout=self.timeout)
+                except (IOError, TypeError, Timeout) as error:
+                    status = type(error).__name__
+                    continue
+            status = response.status_code
+            #server side errors and rate limiting are worth another try, anything else is final
+            if response.status_code >= 500 or response.status_code == 429:
+                continue
+            if self.cache_dir and response.status_code == 200:
+                self._store(cache_path, response.text)
+            instrument.event('fetch', url=link, cache_hit=False, status=status, retries=attempt,
+                             bytes=len(response.content), latency=time.perf_counter() - request_start,
+                             seconds=time.perf_counter() - start)
+            return response.text
+        instrument.event('fetch', url=link, cache_hit=False, status=status, retries=self.retries, failed=True,
+                         seconds=time.perf_counter() - start)
+        instrument.logger.warning('request error: %s', link)
+
+    def _store(self, cache_path, text):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        #written under a per-thread name and then moved, so a crash never leaves a partial page
+        tmp_path = cache_path + '.' + str(threading.get_ident())
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(tmp_path, cache_path)
+
+    def page(self, link, refresh=False):
+        text = self.get(link, refresh=refresh)
+        if text is not None:
+            return html.fromstring(text)
+
+    def map(self, func, iterable):
+        """
+        Applies func to every item on the thread pool, yielding the results in input order
+        as soon as each one (and everything before it) is done.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from executor.map(func, iterable)
+
+
+def tournaments(output=DATA_REPO + 'tournaments.jsonl', verbose=True, fetcher=None, resume=True):
+    """
+    Each tournament is appended to output as soon as it is parsed, so an interrupted run picks up
+    where it stopped. Pass resume=False to rewrite output (from the page cache) after a parser fix.
+    """
+    fetcher = fetcher or Fetcher()
     if not os.path.isdir(DATA_REPO):
         os.makedirs(DATA_REPO)
-    for i in itertools.count(1):
-        link = URL + str(i)
-        try:
-            page = html.fromstring(requests.get(link, timeout=10).text)
-        except (IOError, TypeError, Timeout):
-            print('request error')
-            continue
-        try:
-            t_format = page.xpath('/html/body/div/p')[0].text.strip('\n').split(':')[1]
-        except IndexError:
-            #If there is no colon, we have run out of tournaments IDs
-            break
-        try:
-            date = page.xpath('/html/body/div[2]/p/text()[2]')[0].strip('\n').split(':')[1]
-        except IndexError:
-            continue
-        name = page.xpath('/html/body/div[2]/h2')[0].text.strip('\n')
-        deck_stats = [b for a in page.xpath('/html/body//div/table//tr') for b in a.xpath('td')]
-        elements = list(zip([element.text for element in deck_stats[0::5]],
-                            [element.text for element in deck_stats[1::5]],
-                            [element.xpath('a[@href]')[0].attrib['href'] for element in deck_stats[2::5] if element]))
-        elements = filter(lambda x: x[0] and x[1] and x[2] and x[0].isnumeric()
-                          and x[1].isnumeric() and x[2].split('/')[-1].isnumeric(), elements)
-        decks = [dict(wins=deck[0], losses=deck[1], id=deck[2].split('/')[-1]) for deck in elements]
-        tourney_data = dict(decks=decks, name=name, date=date, format=t_format, id=str(i))
-        if verbose:
-            print(tourney_data)
-        add_tourney(tourney_data)
-    with open(output, 'w') as writefile:
-        json.dump(tourney_list, writefile, indent=4, sort_keys=True, separators=(',', ': '))
+    done = {tourney['id'] for tourney in read_records(output)} if resume and os.path.isfile(output) else set()
+
+    def scrape():
+        for i in itertools.count(1):
+            if str(i) in done:
+                continue
+            link = URL + str(i)
+            page = fetcher.page(link)
+            if page is None:
+                continue
+            try:
+                t_format = page.xpath('/html/body/div/p')[0].text.strip('\n').split(':')[1]
+            except IndexError:
+                #the end of the list moves as tournaments are added, so a cached end page is checked again
+                page = fetcher.page(link, refresh=True)
+                try:
+                    t_format = page.xpath('/html/body/div/p')[0].text.strip('\n').split(':')[1]
+                except (AttributeError, IndexError):
+                    #If there is no colon, we have run out of tournaments IDs
+                    break
+            try:
+                date = page.xpath('/html/body/div[2]/p/text()[2]')[0].strip('\n').split(':')[1]
+            except IndexError:
+                continue
+            name = page.xpath('/html/body/div[2]/h2')[0].text.strip('\n')
+            deck_stats = [b for a in page.xpath('/html/body//div/table//tr') for b in a.xpath('td')]
+            elements = list(zip([element.text for element in deck_stats[0::5]],
+                                [element.text for element in deck_stats[1::5]],
+                                [element.xpath('a[@href]')[0].attrib['href'] for element in deck_stats[2::5] if element]))
+            elements = filter(lambda x: x[0] and x[1] and x[2] and x[0].isnumeric()
+                              and x[1].isnumeric() and x[2].split('/')[-1].isnumeric(), elements)
+            decks = [dict(wins=deck[0], losses=deck[1], id=deck[2].split('/')[-1]) for deck in elements]
+            tourney_data = dict(decks=decks, name=name, date=date, format=t_format, id=str(i))
+            instrument.event('tournament', id=tourney_data['id'], decks=len(decks))
+            if verbose:
+                instrument.logger.info('tournament %s: %s, %d decks', tourney_data['id'], name, len(decks))
+            yield tourney_data
+    write_records(output, scrape(), append=resume)
 
 
 def ml_tournament_ids(mtg_format=['constructed', 'limited'],
@@ -58,43 +192,49 @@ def ml_tournament_ids(mtg_format=['constructed', 'limited'],
                                'po1/po1/po2/po2/p3k/p3k sealed', '4e/4e/4e/4e/4e/4e sealed',
                                'hl/hl/hl/hl/hl/hl sealed', 'ia/ia/al/al/csp/csp sealed', 'mi/mi/vi/vi/wl/wl sealed',
                                'random format tournament (rft)', 'bring your own t2', 'dk/dk/dk/dk/dk/dk sealed'],
-                      output=False, verbose=True):
+                      output=False, verbose=True, fetcher=None, base_url=ML_URL):
+    fetcher = fetcher or Fetcher()
     id_list = list()
     add_ids = id_list.extend
+    formats = dict()
     if not os.path.isdir(DATA_REPO):
         os.makedirs(DATA_REPO)
-    for i in range(0, 3):
-        link = ML_URL + 'tourney_list.php?start=' + str(i)
-        try:
-            page = html.fromstring(requests.get(link, timeout=10).text)
-        except (IOError, TypeError, Timeout):
-            print('request error')
+    #the listings change with every new tournament, so they are always fetched again
+    pages = fetcher.map(lambda link: fetcher.page(link, refresh=True),
+                        [base_url + 'tourney_list.php?start=' + str(i) for i in range(0, 3)])
+    for i, page in enumerate(pages):
+        if page is None:
             continue
         #only stores ids of tournaments that match the specified mtg_format(s)
-        ids = [b.text for a in page.xpath('/html/body/table//tr[2]/td[2]/div[2]/table//tr')
-               for b in a.xpath('td/a[@href]') if a.xpath('td[4]')[0].text.lower() in mtg_format
-               and a.xpath('td[3]')[0].text.lower() not in exclude]
+        id_formats = [(b.text, a.xpath('td[4]')[0].text.lower())
+                      for a in page.xpath('/html/body/table//tr[2]/td[2]/div[2]/table//tr')
+                      for b in a.xpath('td/a[@href]') if a.xpath('td[4]')[0].text.lower() in mtg_format
+                      and a.xpath('td[3]')[0].text.lower() not in exclude]
+        ids = [id for id, t_format in id_formats]
         add_ids(ids)
+        formats.update(id_formats)
+        instrument.event('tournament_ids', page=i, ids=len(ids))
         if verbose:
-            print(ids)
-            print(i)
+            instrument.logger.info('page %d: %d tournament ids', i, len(ids))
     if output:
         write_path = DATA_REPO + 'tournament_ids_' + '_'.join(mtg_format) + '.json'
         with open(write_path, 'w') as writefile:
             json.dump(id_list, writefile, indent=4, sort_keys=True, separators=(',', ': '))
+        #the format of every tournament, so scraped data can be tagged with it
+        with open(DATA_REPO + 'tournament_formats_' + '_'.join(mtg_format) + '.json', 'w') as writefile:
+            json.dump(formats, writefile, indent=4, sort_keys=True, separators=(',', ': '))
     else:
         return id_list
 
 
-def ml_tournament_player_data(tournament_id):
+def ml_tournament_player_data(tournament_id, fetcher=None, base_url=ML_URL, refresh=False):
     """
     Includes player names, player decks, and player records for the tournament in question.
     """
-    link = ML_URL + 'tournament/info.php?id=' + str(tournament_id) + '&view=decks'
-    try:
-        page = html.fromstring(requests.get(link, timeout=10).text)
-    except (IOError, TypeError, Timeout):
-        print('request error')
+    fetcher = fetcher or Fetcher()
+    link = base_url + 'tournament/info.php?id=' + str(tournament_id) + '&view=decks'
+    page = fetcher.page(link, refresh=refresh)
+    if page is None:
         return
     players_records = [(a.text.split('|')[0].split(':')[-1].strip(' '),
                         a.text.split('|')[-1].split(':')[-1].strip(' '))
@@ -109,61 +249,124 @@ def ml_tournament_player_data(tournament_id):
     return players, records, decks
 
 
-def ml_tournament_matchups(tournament_id, round_count):
-    links = (ML_URL + 'tournament/info.php?id=' + str(tournament_id) + '&round=' + str(i)
+def ml_tournament_matchups(tournament_id, round_count, fetcher=None, base_url=ML_URL, refresh=False):
+    """
+    Every matchup of every round, or None if a round can't be fetched or has no results yet.
+    """
+    fetcher = fetcher or Fetcher()
+    links = (base_url + 'tournament/info.php?id=' + str(tournament_id) + '&round=' + str(i)
              for i in range(1, round_count + 1))
     matchups = list()
     for link in links:
-        try:
-            page = html.fromstring(requests.get(link, timeout=10).text)
-        except (IOError, TypeError, Timeout):
-            print('request error')
+        page = fetcher.page(link, refresh=refresh)
+        if page is None:
             return
         round_matchups = [(a.xpath('td')[1].text.split(' ')[-1].strip('()'),
                            a.xpath('td')[3].text.split(' ')[-1].strip('()'),
                            a.xpath('td')[4].text) for a in page.xpath('//table[3]//tr') if a.xpath('td')]
+        #a round that hasn't been (fully) played yet
+        if not round_matchups or not all(result and result.strip() for _, _, result in round_matchups):
+            return
         matchups.extend(round_matchups)
     return matchups
 
 
-def ml_tournament(mtg_format=['constructed', 'limited'], output=True, verbose=True):
+def ml_tournament_data(tournament_id, fetcher=None, base_url=ML_URL, refresh=False):
+    """
+    Scrapes a single tournament, or returns None if any of its pages can't be fetched or it isn't
+    finished yet. Cached pages of a tournament that looks unfinished are fetched again once, since
+    they may have been cached while it was still running.
+    """
+    fetcher = fetcher or Fetcher()
+    page = fetcher.page(base_url + 'tournament/info.php?id=' + str(tournament_id), refresh=refresh)
+    if page is None:
+        return
+    try:
+        players, records, decks = ml_tournament_player_data(tournament_id, fetcher=fetcher, base_url=base_url,
+                                                            refresh=refresh)
+    except TypeError:
+        return
+    #make sure all the data is present
+    if not any(players):
+        return
+    round_count = math.ceil(math.log2(len(players)))
+
+    date = page.xpath('/html/body/table//tr[2]/td[2]/div[2]//table[2]//tr[2]/td[2]')[0].text.split(' ')[1]
+
+    matchups = ml_tournament_matchups(tournament_id, round_count=round_count, fetcher=fetcher, base_url=base_url,
+                                      refresh=refresh)
+    if matchups is None:
+        if not refresh:
+            return ml_tournament_data(tournament_id, fetcher=fetcher, base_url=base_url, refresh=True)
+        return
+    return dict(id=tournament_id, date=date, matchups=matchups,
+                entries=[dict(player=players[i], deck=decks[i], record=records[i]) for i in range(len(players))])
+
+
+def ml_tournament(mtg_format=['constructed', 'limited'], output=True, verbose=True, fetcher=None, base_url=ML_URL,
+                  resume=True, unified=None):
+    """
+    Scrapes every tournament in the id list concurrently. Results keep the order of the id list
+    regardless of which requests finish first, and each is tagged with its format. With output set,
+    each tournament is appended to tournament_data_*.jsonl (or the unified tournament_data.jsonl
+    shared by all formats, which is the default once it exists) as soon as it is parsed, so an
+    interrupted run only scrapes what is missing from it. Pass resume=False to rewrite it (from the
+    page cache) after a parser fix; in the unified file that only rewrites the tournaments of mtg_format.
+    """
+    fetcher = fetcher or Fetcher()
+    if unified is None:
+        unified = os.path.isfile(dataset_path(DATA_REPO + 'tournament_data'))
     path = DATA_REPO + 'tournament_ids_' + '_'.join(mtg_format) + '.json'
-    if not os.path.isfile(path):
-        ml_tournament_ids(mtg_format=mtg_format)
-    with open(path) as file:
-        ids = json.load(file)
-    tournament_data = list()
-    add_data = tournament_data.append
-    for id in ids:
-        link = ML_URL + 'tournament/info.php?id=' + str(id)
-        try:
-            page = html.fromstring(requests.get(link, timeout=10).text)
-        except (IOError, TypeError, Timeout):
-            print('request error')
-            continue
-        try:
-            players, records, decks = ml_tournament_player_data(id)
-        except TypeError:
-            continue
-        #make sure all the data is present
-        if not any(players):
-            continue
-        round_count = math.ceil(math.log2(len(players)))
+    formats_path = DATA_REPO + 'tournament_formats_' + '_'.join(mtg_format) + '.json'
+    ids, formats = None, dict()
+    if os.path.isfile(path):
+        with open(path) as file:
+            ids = json.load(file)
+    if os.path.isfile(formats_path):
+        with open(formats_path) as file:
+            formats = json.load(file)
+    #id lists from before formats were kept come without a format map; both are listed again then
+    if ids is None or any(id not in formats for id in ids):
+        ml_tournament_ids(mtg_format=mtg_format, output=True, verbose=verbose, fetcher=fetcher, base_url=base_url)
+        with open(path) as file:
+            ids = json.load(file)
+        with open(formats_path) as file:
+            formats = json.load(file)
+    done = set()
+    if output:
+        base = 'tournament_data' if unified else 'tournament_data_' + '_'.join(mtg_format)
+        write_path = dataset_path(DATA_REPO + base)
+        if write_path.endswith('.json'):
+            write_path = convert(write_path)
+        if resume and os.path.isfile(write_path):
+            done = {data['id'] for data in read_records(write_path)}
+        elif unified and os.path.isfile(write_path):
+            #the unified file is shared by every format, so only the tournaments of mtg_format are dropped
+            tmp_path = DATA_REPO + 'tournament_data.tmp' + write_path[len(DATA_REPO + 'tournament_data'):]
+            write_records(tmp_path, (data for data in read_records(write_path) if data.get('format') not in mtg_format))
+            os.replace(tmp_path, write_path)
 
-        date = page.xpath('/html/body/table//tr[2]/td[2]/div[2]//table[2]//tr[2]/td[2]')[0].text.split(' ')[1]
+    def scrape_one(id):
+        data = ml_tournament_data(id, fetcher=fetcher, base_url=base_url)
+        if data is not None:
+            data['format'] = formats[id]
+        return data
 
-        matchups = ml_tournament_matchups(id, round_count=round_count)
-        data = dict(id=id, date=date, matchups=matchups,
-                    entries=[dict(player=players[i], deck=decks[i], record=records[i]) for i in range(len(players))])
-        add_data(data)
-        if verbose:
-            print(data)
+    def scrape():
+        missing = [id for id in ids if id not in done]
+        for data in fetcher.map(scrape_one, missing):
+            if data is None:
+                continue
+            instrument.event('tournament', id=data['id'], format=data.get('format'), entries=len(data['entries']),
+                             matchups=len(data['matchups']))
+            if verbose:
+                instrument.logger.info('tournament %s: %d entries, %d matchups', data['id'], len(data['entries']),
+                                       len(data['matchups']))
+            yield data
     if output:
-        write_path = DATA_REPO + 'tournament_data_' + '_'.join(mtg_format) + '.json'
-        with open(write_path, 'w') as writefile:
-            json.dump(tournament_data, writefile, indent=4, sort_keys=True, separators=(',', ': '))
+        write_records(write_path, scrape(), append=resume or unified)
     else:
-        return tournament_data
+        return list(scrape())
 
 
 def file_gen(path, *exts):
@@ -174,57 +377,100 @@ def file_gen(path, *exts):
             for file in files if any(file.endswith(ext) for ext in exts))
 
 
-def scg_deck_data(path=DATA_REPO + 'scg_decks/', output=True, verbose=True):
-    deck_files = file_gen(path, 'Deck.html')
-    decks = list()
-    add_deck = decks.append
+#compiled once per process instead of being re-parsed for every page
+SCG_XPATHS = dict(
+    name=etree.XPath('//*[@id="article_content"]/div/div[1]/div[1]/header[1]/a'),
+    player=etree.XPath('//*[@id="article_content"]/div/div[1]/div[1]/header[2]/a'),
+    event_header=etree.XPath('//*[@id="article_content"]/div//div[1]/header[3]'),
+    event=etree.XPath('a'),
+    date=etree.XPath('//*[@id="article_content"]/div/div[1]/div[1]/header[3]/text()[2]'),
+    types=etree.XPath('//*[@id="article_content"]/div/div[3]/div/h3'),
+    cards=etree.XPath('//ul[@rel]/li'),
+    card_name=etree.XPath('a'),
+)
+
+
+def scg_deck(deck_file):
+    """
+    Parses a single SCG Deck.html page.
+    """
+    with open(deck_file) as file:
+        page = html.fromstring(file.read())
+    deck_name = SCG_XPATHS['name'](page)[0].text
+    player_name = SCG_XPATHS['player'](page)[0].text
+    event_header = SCG_XPATHS['event_header'](page)[0]
+    #scg has weird formatting, hence the extended space in the split.
+    rank = event_header.text.split('			')[1][:-2]
+    tournament = SCG_XPATHS['event'](event_header)[0].text
+    date = SCG_XPATHS['date'](page)[0].split(' ')[-1]
+    deck_types = [(a.text.replace('(', '').replace(')', '').split(' ')[0],
+                  int(a.text.replace('(', '').replace(')', '').split(' ')[1]))
+                  for a in SCG_XPATHS['types'](page)]
+    cards = [(SCG_XPATHS['card_name'](a)[0].text, int(a.text)) for a in SCG_XPATHS['cards'](page)]
+    return dict(name=deck_name, player=player_name, rank=rank, event=tournament, date=date,
+                card=dict(types=deck_types, names=cards), file=deck_file)
+
+
+def scg_deck_data(path=DATA_REPO + 'scg_decks/', output=True, verbose=True, processes=None):
+    """
+    Parses every Deck.html under path on a process pool, streaming the decks to scg9272814.jsonl
+    in file order as they are done. Files whose mtime and size match the last run are skipped;
+    decks from files that changed or disappeared are dropped from the output first.
+    """
+    deck_files = sorted(file_gen(path, 'Deck.html'))
+    write_path = DATA_REPO + 'scg9272814.jsonl'
+    manifest_path = write_path + '.manifest'
+    stamps = dict()
     for deck_file in deck_files:
-        with open(deck_file) as file:
-            page = html.fromstring(file.read())
-        deck_name = page.xpath('//*[@id="article_content"]/div/div[1]/div[1]/header[1]/a')[0].text
-        if verbose:
-            print(deck_name)
-        player_name = page.xpath('//*[@id="article_content"]/div/div[1]/div[1]/header[2]/a')[0].text
-        #scg has weird formatting, hence the extended space in the split.
-        rank = page.xpath('//*[@id="article_content"]/div//div[1]/header[3]')[0].text.split('			')[1][:-2]
-        tournament = page.xpath('//*[@id="article_content"]/div//div[1]/header[3]/a')[0].text
-        date = page.xpath('//*[@id="article_content"]/div/div[1]/div[1]/header[3]/text()[2]')[0].split(' ')[-1]
-        deck_types = [(a.text.replace('(', '').replace(')', '').split(' ')[0],
-                      int(a.text.replace('(', '').replace(')', '').split(' ')[1]))
-                      for a in page.xpath('//*[@id="article_content"]/div/div[3]/div/h3')]
-        cards = [(a.xpath('a')[0].text, int(a.text)) for a in page.xpath('//ul[@rel]/li')]
-        deck_data = dict(name=deck_name, player=player_name, rank=rank, event=tournament, date=date,
-                         card=dict(types=deck_types, names=cards))
-        add_deck(deck_data)
-    if output:
-        write_path = DATA_REPO + 'scg9272814.json'
-        with open(write_path, 'w') as writefile:
-            json.dump(decks, writefile, indent=4, sort_keys=True, separators=(',', ': '))
-    else:
-        return decks
+        stat = os.stat(deck_file)
+        stamps[deck_file] = [stat.st_mtime_ns, stat.st_size]
+    manifest = dict()
+    if output and os.path.isfile(manifest_path) and os.path.isfile(write_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    unchanged = {deck_file for deck_file, stamp in manifest.items() if stamps.get(deck_file) == stamp}
+    if len(unchanged) < len(manifest):
+        write_records(write_path, [deck for deck in read_records(write_path) if deck['file'] in unchanged])
+    manifest = {deck_file: manifest[deck_file] for deck_file in unchanged}
+    append = bool(manifest)
+    todo = [deck_file for deck_file in deck_files if deck_file not in unchanged]
 
+    def parse():
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for deck_data in executor.map(scg_deck, todo, chunksize=16):
+                if verbose:
+                    instrument.logger.info('deck %s: %s', deck_data['file'], deck_data['name'])
+                yield deck_data
+                #only reached once the deck has been written
+                manifest[deck_data['file']] = stamps[deck_data['file']]
+    if not output:
+        with instrument.stage('scg_parse', files=len(todo), unchanged=len(unchanged)):
+            return list(parse())
+    try:
+        with instrument.stage('scg_parse', files=len(todo), unchanged=len(unchanged)):
+            write_records(write_path, parse(), append=append)
+    finally:
+        with open(manifest_path, 'w') as writefile:
+            json.dump(manifest, writefile)
 
-def scg_card_data(deck_data=DATA_REPO + 'scg9272814.json', min_plays=20, card_combo=False, output=False):
-    card_data = defaultdict(list)
-    with open(deck_data) as file:
-        data = json.load(file)
-    for deck in data:
+
+def scg_card_data(deck_data=None, min_plays=20, card_combo=False, output=False, processes=None):
+    deck_data = deck_data or dataset_path(DATA_REPO + 'scg9272814')
+    corpus = deck_corpus(deck_data, data_repo=DATA_REPO)
+    names = corpus['meta']['cards']
+    with instrument.stage('rank_stats', card_combo=card_combo, decks=len(corpus['ranks'])):
         if card_combo:
-            for card_group in itertools.combinations(deck['card']['names'], r=card_combo):
-                #get card names and join them with semi-colon
-                card_name = '; '.join([card[0] for card in card_group])
-                card_count = sum([card[1] for card in card_group])
-                #appends x instances of the rank of the deck, where x is the quantity of the card in question
-                card_data[card_name] += card_count*[int(deck['rank'])]
+            #combinations are streamed into running accumulators, pruned by min_plays level by level
+            card_data = [('; '.join(names[card] for card in cards), stats)
+                         for cards, stats in combo_rank_stats(corpus, card_combo, min_plays=min_plays,
+                                                              processes=processes)]
         else:
-            for card in deck['card']['names']:
-                card_data[card[0]] += card[1]*[int(deck['rank'])]
-
-    for card in card_data:
-        card_data[card] = (np.mean(card_data[card]), np.std(card_data[card]), len(card_data[card]))
+            #single cards come straight from the integer-encoded deck corpus
+            mean, std, plays = card_rank_stats(corpus)
+            card_data = [(name, (float(mean[i]), float(std[i]), int(plays[i]))) for i, name in enumerate(names)]
 
     #only want cards that appear min_plays or more times
-    card_data = [item for item in card_data.items() if item[1][2] >= min_plays]
+    card_data = [item for item in card_data if item[1][2] >= min_plays]
 
     if output:
         write_path = output
@@ -259,6 +505,7 @@ def scg_sorted(deck_data_path, sort_key='appearances', reverse=True, output=True
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
     ml_tournament_ids(output=True)
     ml_tournament()
     #scg_card_data(card_combo=4, output=DATA_REPO + 'scg9272814data4combo.json')
@@ -0,0 +1,165 @@
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+#Mersenne prime for the MinHash hash family (a*x + b) mod p
+MINHASH_PRIME = 2**31 - 1
+
+
+class Hypergraph(object):
+    """
+    Decks as hyperedges over card IDs. incidence is the deck by card CSR matrix (1 where the deck
+    plays the card) and postings its CSC twin, whose columns are the card -> deck postings lists.
+    wins and losses hold the games every deck won and lost, when known.
+    """
+    def __init__(self, offsets, cards, n_cards, wins=None, losses=None):
+        n_decks = len(offsets) - 1
+        #copied, since corpus arrays are read-only memory maps and sorting the indices writes to them
+        incidence = sp.sparse.csr_matrix((np.ones(len(cards)), np.array(cards), np.array(offsets)),
+                                         shape=(n_decks, n_cards))
+        incidence.sum_duplicates()
+        #a card listed twice in a deck (main deck and sideboard) is still a single vertex of that edge
+        incidence.data[:] = 1
+        self.incidence = incidence
+        self.postings = incidence.tocsc()
+        self.deck_sizes = np.diff(incidence.indptr)
+        self.wins = np.zeros(n_decks) if wins is None else np.asarray(wins, dtype=float)
+        self.losses = np.zeros(n_decks) if losses is None else np.asarray(losses, dtype=float)
+        self.signatures = None
+
+    @classmethod
+    def from_corpus(cls, corpus, n_cards, deck_mask=None):
+        """
+        The hypergraph of a tournament corpus, optionally keeping only the decks in deck_mask.
+        """
+        offsets, cards = np.asarray(corpus['offsets']), np.asarray(corpus['cards'])
+        n_decks = len(offsets) - 1
+        matchups, wins = np.asarray(corpus['matchups']), np.asarray(corpus['wins'], dtype=float)
+        #each matchup row is (deck a, deck b) with wins (a's, b's)
+        deck_wins = np.bincount(matchups[:, 0], wins[:, 0], n_decks) + np.bincount(matchups[:, 1], wins[:, 1], n_decks)
+        deck_losses = (np.bincount(matchups[:, 0], wins[:, 1], n_decks) +
+                       np.bincount(matchups[:, 1], wins[:, 0], n_decks))
+        if deck_mask is not None:
+            keep = np.flatnonzero(deck_mask)
+            sizes = np.diff(offsets)[keep]
+            new_offsets = np.concatenate([[0], np.cumsum(sizes)])
+            listings = np.repeat(offsets[keep] - new_offsets[:-1], sizes) + np.arange(new_offsets[-1])
+            offsets, cards = new_offsets, cards[listings]
+            deck_wins, deck_losses = deck_wins[keep], deck_losses[keep]
+        return cls(offsets, cards, n_cards, wins=deck_wins, losses=deck_losses)
+
+    def decks_with(self, card_ids):
+        """
+        IDs of the decks playing every card in card_ids, intersecting the shortest postings first.
+        """
+        postings = sorted((self.postings.indices[self.postings.indptr[card]:self.postings.indptr[card+1]]
+                           for card in card_ids), key=len)
+        if not postings:
+            return np.arange(self.incidence.shape[0])
+        decks = postings[0]
+        for posting in postings[1:]:
+            if not len(decks):
+                break
+            decks = np.intersect1d(decks, posting, assume_unique=True)
+        return decks
+
+    def cooccurrence(self, card_ids=None):
+        """
+        Number of decks playing both card i and card j, for every i in card_ids (all cards by
+        default) and every j, as a sparse (len(card_ids), n_cards) matrix.
+        """
+        columns = self.postings if card_ids is None else self.postings[:, list(card_ids)]
+        return (columns.T @ self.incidence).tocsr()
+
+    def win_rate(self, card_ids):
+        """
+        Games won and lost by the decks playing every card in card_ids, and the share won.
+        """
+        decks = self.decks_with(card_ids)
+        wins, losses = self.wins[decks].sum(), self.losses[decks].sum()
+        return wins, losses, wins/(wins + losses) if wins + losses else np.nan
+
+    def jaccard(self, card_ids, decks=None):
+        """
+        Jaccard similarity between the set card_ids and every deck (or only those in decks).
+        """
+        card_ids = np.unique(np.asarray(list(card_ids), dtype=np.int64))
+        incidence = self.incidence if decks is None else self.incidence[decks]
+        sizes = self.deck_sizes if decks is None else self.deck_sizes[decks]
+        query = np.zeros(incidence.shape[1])
+        query[card_ids] = 1
+        shared = incidence @ query
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarity = shared/(sizes + len(card_ids) - shared)
+        return np.nan_to_num(similarity)
+
+    def minhash_index(self, num_perm=64, band_rows=4, seed=0, chunk_size=2**16):
+        """
+        Builds MinHash signatures of every deck and the LSH bands nearest() looks candidates up in.
+        With b = num_perm/band_rows bands, decks with Jaccard similarity s share a band with
+        probability 1 - (1 - s**band_rows)**b.
+        """
+        random = np.random.RandomState(seed)
+        self.hash_a = random.randint(1, MINHASH_PRIME, size=num_perm).astype(np.int64)
+        self.hash_b = random.randint(0, MINHASH_PRIME, size=num_perm).astype(np.int64)
+        self.band_rows = band_rows
+        n_decks = self.incidence.shape[0]
+        indptr, indices = self.incidence.indptr, self.incidence.indices.astype(np.int64)
+        signatures = np.full((n_decks, num_perm), MINHASH_PRIME, dtype=np.int64)
+        #decks are hashed a chunk at a time so memory stays at chunk_size listings times num_perm
+        start = 0
+        while start < n_decks:
+            stop = int(np.searchsorted(indptr, indptr[start] + chunk_size, side='right')) - 1
+            stop = min(max(stop, start + 1), n_decks)
+            chunk = indices[indptr[start]:indptr[stop]]
+            if len(chunk):
+                hashes = (np.outer(chunk, self.hash_a) + self.hash_b) % MINHASH_PRIME
+                starts = indptr[start:stop] - indptr[start]
+                filled = np.flatnonzero(np.diff(indptr[start:stop+1]))
+                signatures[start + filled] = np.minimum.reduceat(hashes, starts[filled], axis=0)
+            start = stop
+        self.signatures = signatures
+        self.bands = list()
+        for band in range(num_perm // band_rows):
+            keys = self._band_keys(signatures, band)
+            order = np.argsort(keys, kind='stable')
+            self.bands.append((keys[order], order))
+        return self
+
+    def _band_keys(self, signatures, band):
+        """
+        One 64 bit hash per row of the band'th slice of signatures.
+        """
+        rows = signatures[:, band*self.band_rows:(band + 1)*self.band_rows].astype(np.uint64)
+        keys = np.zeros(len(rows), dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for column in rows.T:
+                keys = keys*np.uint64(1000003) ^ column
+        return keys
+
+    def signature(self, card_ids):
+        """
+        MinHash signature of the set card_ids, under the hash family of minhash_index.
+        """
+        card_ids = np.unique(np.asarray(list(card_ids), dtype=np.int64))
+        if not len(card_ids):
+            return np.full(len(self.hash_a), MINHASH_PRIME, dtype=np.int64)
+        return ((np.outer(card_ids, self.hash_a) + self.hash_b) % MINHASH_PRIME).min(axis=0)
+
+    def nearest(self, card_ids, k=10, lsh=True):
+        """
+        The k decks most similar to the set card_ids by Jaccard similarity, best first, as
+        (deck IDs, similarities). With lsh set (and minhash_index built) only decks sharing an LSH
+        band with the query are scored, otherwise every deck is.
+        """
+        decks = None
+        if lsh and self.signatures is not None:
+            query = self.signature(card_ids)[None, :]
+            candidates = list()
+            for band, (keys, order) in enumerate(self.bands):
+                key = self._band_keys(query, band)[0]
+                candidates.append(order[np.searchsorted(keys, key, 'left'):np.searchsorted(keys, key, 'right')])
+            decks = np.unique(np.concatenate(candidates))
+        similarity = self.jaccard(card_ids, decks=decks)
+        best = np.argsort(-similarity, kind='stable')[:k]
+        return (best if decks is None else decks[best]), similarity[best]
@@ -0,0 +1,189 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+DATA_REPO = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + '/data/'
+logger = logging.getLogger('mtg-hypergraph')
+
+#the off switch: while False, event() returns at once and stage() hands back a shared no-op context
+enabled = False
+sinks = list()
+options = dict(memory=False, profile=False, profile_dir=DATA_REPO + 'profiles/')
+_local = threading.local()
+
+
+class LogSink(object):
+    """
+    Logs every event as one line: its kind, then its fields as JSON.
+    """
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def emit(self, record):
+        fields = {key: value for key, value in record.items() if key != 'kind'}
+        self.logger.log(self.level, '%s %s', record['kind'], json.dumps(fields, sort_keys=True, default=str))
+
+    def close(self):
+        pass
+
+
+class JSONSink(object):
+    """
+    Appends every event to the metrics file at path as one line of JSON.
+    """
+    def __init__(self, path=DATA_REPO + 'metrics.jsonl'):
+        if not os.path.isdir(os.path.dirname(path) or '.'):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, sort_keys=True, default=str) + '\n'
+        with self._lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Collector(object):
+    """
+    Keeps every event in memory, in events.
+    """
+    def __init__(self):
+        self.events = list()
+
+    def emit(self, record):
+        self.events.append(record)
+
+    def close(self):
+        pass
+
+
+def enable(*new_sinks, memory=False, profile=False, profile_dir=DATA_REPO + 'profiles/'):
+    """
+    Starts sending events to new_sinks (logging by default). With memory set, every stage also
+    records the peak memory traced by tracemalloc while it ran; with profile set, every outermost
+    stage is run under cProfile and its stats dumped to profile_dir/<stage>.prof.
+    """
+    global enabled
+    sinks.extend(new_sinks or [LogSink()])
+    options.update(memory=memory, profile=profile, profile_dir=profile_dir)
+    enabled = True
+
+
+def disable():
+    """
+    Stops instrumentation and closes every sink.
+    """
+    global enabled
+    enabled = False
+    for sink in sinks:
+        sink.close()
+    del sinks[:]
+
+
+def event(kind, **fields):
+    if not enabled:
+        return
+    record = dict(fields, kind=kind, time=time.time())
+    for sink in sinks:
+        sink.emit(record)
+
+
+class Stage(object):
+    """
+    Times the code it wraps and sends it as a 'stage' event, along with anything passed to set().
+    Stages nest: the peak memory of a stage includes the peaks of the stages inside it. Memory is
+    traced process wide, so peaks are only meaningful for stages run from a single thread.
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.profiler = None
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def _fold(self):
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', list())
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self.traced = options['memory']
+        if self.traced:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            elif self.parent is not None and self.parent.traced:
+                #the parent's peak so far, before it is reset for this stage
+                self.parent._fold()
+            self.base = self.peak = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        if options['profile'] and not getattr(_local, 'profiling', False):
+            _local.profiling = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start, self.cpu_start = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fields = dict(self.fields, stage=self.name, seconds=time.perf_counter() - self.start,
+                      cpu_seconds=time.process_time() - self.cpu_start)
+        if exc_type is not None:
+            fields['error'] = exc_type.__name__
+        if self.profiler is not None:
+            self.profiler.disable()
+            _local.profiling = False
+            if not os.path.isdir(options['profile_dir']):
+                os.makedirs(options['profile_dir'], exist_ok=True)
+            fields['profile'] = options['profile_dir'] + self.name + '.prof'
+            self.profiler.dump_stats(fields['profile'])
+        if self.traced:
+            self._fold()
+            fields['peak_bytes'] = self.peak - self.base
+            if self.started_tracing:
+                tracemalloc.stop()
+            elif self.parent is not None and self.parent.traced:
+                self.parent.peak = max(self.parent.peak, self.peak)
+        _local.stack.pop()
+        event('stage', **fields)
+
+
+class _NullStage(object):
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_STAGE = _NullStage()
+
+
+def stage(name, **fields):
+    """
+    Context manager timing the stage name, as in
+        with stage('matrix', mtg_format=mtg_format) as s:
+            ...
+            s.set(cache_hit=True)
+    """
+    return Stage(name, fields) if enabled else NULL_STAGE
+
+
+#batch jobs can switch metrics on without code changes: MTG_METRICS=log, or the path of a metrics file
+if os.environ.get('MTG_METRICS'):
+    enable(LogSink() if os.environ['MTG_METRICS'] == 'log' else JSONSink(os.environ['MTG_METRICS']),
+           memory=bool(os.environ.get('MTG_METRICS_MEMORY')), profile=bool(os.environ.get('MTG_METRICS_PROFILE')))
@@ -0,0 +1,216 @@
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import math
+import threading
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+from adjacency import card_key, matrix, ranking_index, bernoulli_confidence_interval, grouped_top_k
+import instrument
+
+
+class CardQuery(object):
+    """
+    Long-lived answers to matchup queries on one format and matrix variant. The card key, ranking
+    index, raw counts and proportion matrix are loaded once; every query takes a batch of cards
+    (names or IDs) and computes whatever isn't in the LRU cache of recent results in one go.
+    """
+    def __init__(self, mtg_format=['constructed', 'limited'], ignore_count=True, norm=0.1, cache_size=4096):
+        self.mtg_format = mtg_format
+        self.card_dict = card_key(mtg_format=mtg_format)
+        self.names = [None]*len(self.card_dict)
+        for card, index in self.card_dict.items():
+            self.names[index] = card
+        self.index = ranking_index(mtg_format=mtg_format, ignore_count=ignore_count, norm=norm,
+                                   card_dict=self.card_dict)
+        self.counts = matrix(mtg_format=mtg_format, ignore_count=ignore_count)
+        self.proportions = matrix(mtg_format=mtg_format, ignore_count=ignore_count, proportion=True, norm=norm)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ids(self, cards):
+        """
+        Card IDs of cards, which may be names or IDs. Raises KeyError for unknown cards.
+        """
+        ids = list()
+        for card in cards:
+            if isinstance(card, str) and not card.isdigit():
+                ids.append(self.card_dict[card])
+            elif 0 <= int(card) < len(self.names):
+                ids.append(int(card))
+            else:
+                raise KeyError(card)
+        return np.array(ids, dtype=np.int64)
+
+    def _cached(self, kind, keys, compute):
+        """
+        Results for every key in keys, from the cache where possible; compute is called once with
+        the keys that are missing and returns their results in the same order.
+        """
+        with self._lock:
+            results = [self._cache.get((kind, key)) for key in keys]
+            for key, result in zip(keys, results):
+                if result is not None:
+                    self._cache.move_to_end((kind, key))
+        missing = list(dict.fromkeys(key for key, result in zip(keys, results) if result is None))
+        with instrument.stage('query', kind=kind, batch=len(keys), missing=len(missing)):
+            computed = dict(zip(missing, compute(missing))) if missing else dict()
+        with self._lock:
+            for key, result in computed.items():
+                self._cache[(kind, key)] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return [computed[key] if result is None else result for key, result in zip(keys, results)]
+
+    def matchups(self, cards, top_x=30):
+        """
+        For every card, best_cards_against it: the top_x cards with the best lower bound against it,
+        as (name, (mean, lower, upper)) pairs.
+        """
+        index = self.index
+
+        def compute(keys):
+            ids = np.array([key[0] for key in keys], dtype=np.int64)
+            starts, stops = index['against_indptr'][ids], index['against_indptr'][ids + 1]
+            lengths = stops - starts
+            #the against slices of the whole batch, concatenated
+            groups = np.repeat(np.arange(len(ids)), lengths)
+            positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            pairs = index['against_pairs'][positions]
+            conf_ints = index['pair_ints'][pairs]
+            chosen = grouped_top_k(conf_ints[:, 1], groups, top_x)
+            results = [list() for _ in keys]
+            for group, row, conf_int in zip(groups[chosen], index['pair_rows'][pairs[chosen]], conf_ints[chosen]):
+                results[group].append((self.names[row], tuple(conf_int)))
+            return results
+        return self._cached('matchups', [(int(card), top_x) for card in self.ids(cards)], compute)
+
+    def top_k(self, cards, k=20, worst=False):
+        """
+        For every card, the k cards it fares best (worst) against by proportion, as
+        (name, proportion, wins, losses) tuples.
+        """
+        def compute(keys):
+            ids = np.array([key[0] for key in keys], dtype=np.int64)
+            rows = np.asarray(self.proportions[ids])
+            groups = np.repeat(np.arange(len(ids)), rows.shape[1])
+            chosen = grouped_top_k(rows.ravel(), groups, k, reverse=not worst)
+            opponents = chosen % rows.shape[1]
+            wins = np.asarray(self.counts[ids[groups[chosen]], opponents]).ravel()
+            losses = np.asarray(self.counts[opponents, ids[groups[chosen]]]).ravel()
+            results = [list() for _ in keys]
+            for group, opponent, proportion, won, lost in zip(groups[chosen], opponents, rows.ravel()[chosen],
+                                                              wins, losses):
+                results[group].append((self.names[opponent], float(proportion), float(won), float(lost)))
+            return results
+        return self._cached('top_k', [(int(card), k, worst) for card in self.ids(cards)], compute)
+
+    def head_to_head(self, cards_a, cards_b):
+        """
+        Every card of cards_a against every card of cards_b: wins, losses, proportion and the
+        (mean, lower, upper) interval of each pair as len(cards_a) by len(cards_b) lists, plus
+        the same totals for the two sets as a whole.
+        """
+        def compute(keys):
+            results = list()
+            for ids_a, ids_b in keys:
+                ids_a, ids_b = list(ids_a), list(ids_b)
+                wins = self.counts[ids_a][:, ids_b].toarray()
+                losses = self.counts[ids_b][:, ids_a].toarray().T
+                mean, lower, upper = bernoulli_confidence_interval(wins, losses)
+                total = bernoulli_confidence_interval(wins.sum(), losses.sum())
+                results.append(dict(cards_a=[self.names[card] for card in ids_a],
+                                    cards_b=[self.names[card] for card in ids_b],
+                                    wins=wins.tolist(), losses=losses.tolist(),
+                                    proportion=np.asarray(self.proportions[np.ix_(ids_a, ids_b)]).tolist(),
+                                    intervals=np.stack([mean, lower, upper], axis=-1).tolist(),
+                                    total=dict(wins=float(wins.sum()), losses=float(losses.sum()),
+                                               interval=[float(bound) for bound in total])))
+            return results
+        key = (tuple(self.ids(cards_a).tolist()), tuple(self.ids(cards_b).tolist()))
+        return self._cached('head_to_head', [key], compute)[0]
+
+
+def jsonable(value):
+    """
+    value with tuples as lists and NaNs as None, which is all the query results need to be JSON.
+    """
+    if isinstance(value, float):
+        return None if math.isnan(value) else value
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    if isinstance(value, dict):
+        return {key: jsonable(item) for key, item in value.items()}
+    return value
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET /matchups?card=...&card=...&top_x=30, /top_k?card=...&k=20&worst=1 or /head_to_head?a=...&b=...,
+    or POST the same parameters as a JSON object (cards, top_x, k, worst, a, b) to the same paths.
+    """
+    query = None
+
+    def _params(self):
+        if self.command == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+        params = parse_qs(urlsplit(self.path).query)
+        return dict(cards=params.get('card', []), a=params.get('a', []), b=params.get('b', []),
+                    **{name: params[name][0] for name in ('top_x', 'k', 'worst') if name in params})
+
+    def _answer(self):
+        path = urlsplit(self.path).path.strip('/')
+        try:
+            params = self._params()
+            if path == 'matchups':
+                result = self.query.matchups(params['cards'], top_x=int(params.get('top_x', 30)))
+            elif path == 'top_k':
+                result = self.query.top_k(params['cards'], k=int(params.get('k', 20)),
+                                          worst=str(params.get('worst', '')).lower() in ('1', 'true'))
+            elif path == 'head_to_head':
+                result = self.query.head_to_head(params['a'], params['b'])
+            else:
+                return self._send(404, dict(error='unknown query ' + path))
+        except KeyError as error:
+            return self._send(404, dict(error='unknown card ' + str(error)))
+        except (ValueError, TypeError) as error:
+            return self._send(400, dict(error=str(error)))
+        self._send(200, result)
+
+    def _send(self, status, body):
+        data = json.dumps(jsonable(body)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = _answer
+
+    def log_message(self, format, *args):
+        instrument.logger.info('%s %s', self.address_string(), format % args)
+
+
+def serve(query=None, host='127.0.0.1', port=8080, mtg_format=['constructed', 'limited']):
+    """
+    Serves query (a CardQuery on mtg_format by default) over HTTP on host:port until interrupted.
+    Binds to localhost only unless told otherwise.
+    """
+    handler = type('Handler', (QueryHandler,), dict(query=query or CardQuery(mtg_format=mtg_format)))
+    server = ThreadingHTTPServer((host, port), handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves card matchup queries as JSON over HTTP.')
+    parser.add_argument('mtg_format', nargs='*', default=['constructed', 'limited'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    serve(host=args.host, port=args.port, mtg_format=args.mtg_format)
@@ -0,0 +1,249 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DATA_REPO = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + '/data/'
+#preferred first; plain .json is the old single-array format, still read for compatibility
+EXTENSIONS = ('.jsonl', '.jsonl.gz', '.jsonl.zst', '.json')
+#what reading a compressed stream that was cut short by a crash raises
+TRUNCATED = (EOFError, zlib.error, gzip.BadGzipFile) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def open_text(path, mode='rt'):
+    """
+    Opens path in text mode, (de)compressing .gz and .zst files on the fly.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('zstandard is needed to read and write ' + path)
+        return zstandard.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def dataset_path(base):
+    """
+    The file holding the dataset base (a path without extension) in the first format of
+    EXTENSIONS that exists, or the plain JSON Lines path new data should go to.
+    """
+    for ext in EXTENSIONS:
+        if os.path.isfile(base + ext):
+            return base + ext
+    return base + EXTENSIONS[0]
+
+
+def read_records(path):
+    """
+    Yields the records in path one at a time. JSON Lines files are streamed; old-style files
+    holding a single JSON array are loaded whole. A last line cut short by a crash is skipped.
+    """
+    if path.endswith('.json'):
+        with open(path) as file:
+            yield from json.load(file)
+        return
+    with open_text(path) as file:
+        try:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if line.endswith('\n'):
+                        raise
+                    break
+                yield record
+        except TRUNCATED:
+            #a compressed stream that was never closed properly
+            return
+
+
+def _marker(file, offset):
+    """
+    Fingerprint of the (up to) 64 bytes before offset in the binary file.
+    """
+    file.seek(max(0, offset - 64))
+    return hashlib.sha1(file.read(offset - max(0, offset - 64))).hexdigest()
+
+
+def read_records_after(path, offset=0, marker=''):
+    """
+    The records of the plain JSON Lines file at path that start at byte offset or later, the offset
+    just past the last complete line and a marker of the bytes before it. Pass both back in to read
+    only what was appended since. When the bytes before offset no longer match marker the file was
+    rewritten, and it is read from the start again.
+    """
+    records = list()
+    with open(path, 'rb') as file:
+        if offset and (offset > os.path.getsize(path) or _marker(file, offset) != marker):
+            offset = 0
+        file.seek(offset)
+        for line in file:
+            #a partial last line is left for the next read
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            if line.strip():
+                records.append(json.loads(line))
+        return records, offset, _marker(file, offset)
+
+
+def intact(path):
+    """
+    Whether the gzip file at path decompresses to the end and ends in a complete line.
+    """
+    try:
+        with gzip.open(path, 'rb') as file:
+            last = b''
+            for chunk in iter(lambda: file.read(2**20), b''):
+                last = chunk
+    except TRUNCATED:
+        return False
+    return not last or last.endswith(b'\n')
+
+
+def repair(path):
+    """
+    Drops a partial last line from a JSON Lines file so records can be appended after it. Compressed
+    files cut short by a crash are rewritten down to the records that can still be read, as anything
+    appended to them would be unreadable; zstd files always are, since a cut frame can read cleanly.
+    """
+    if not os.path.isfile(path):
+        return
+    if path.endswith(('.gz', '.zst')):
+        if path.endswith('.gz') and intact(path):
+            return
+        directory, name = os.path.split(path)
+        tmp_path = os.path.join(directory, '.tmp.' + name)
+        write_records(tmp_path, read_records(path))
+        os.replace(tmp_path, path)
+        return
+    if not path.endswith('.jsonl'):
+        return
+    with open(path, 'rb+') as file:
+        end = position = file.seek(0, os.SEEK_END)
+        #walk back from the end a chunk at a time until the last newline turns up
+        while position > 0:
+            start = max(0, position - 2**16)
+            file.seek(start)
+            chunk = file.read(position - start)
+            if position == end and chunk.endswith(b'\n'):
+                return
+            newline = chunk.rfind(b'\n')
+            if newline != -1:
+                file.truncate(start + newline + 1)
+                return
+            position = start
+        file.truncate(0)
+
+
+def write_records(path, records, append=False):
+    """
+    Writes every record in records as one line of JSON and returns how many were written.
+    Plain files are flushed after each record, so a generator of scraped data can be written
+    as it is produced and whatever finished before a crash is kept.
+    """
+    if not os.path.isdir(os.path.dirname(path) or '.'):
+        os.makedirs(os.path.dirname(path))
+    if append:
+        repair(path)
+    count = 0
+    with open_text(path, 'at' if append else 'wt') as file:
+        for record in records:
+            file.write(json.dumps(record, sort_keys=True) + '\n')
+            if not path.endswith(('.gz', '.zst')):
+                file.flush()
+            count += 1
+    return count
+
+
+def convert(path, compression=None):
+    """
+    Rewrites an old single-array .json file as JSON Lines (gzip or zstd compressed if compression
+    is 'gz' or 'zst') next to it and returns the new path. The original file is left in place.
+    """
+    new_path = path[:-len('.json')] + '.jsonl' + ('.' + compression if compression else '')
+    write_records(new_path, read_records(path))
+    return new_path
+
+
+def convert_all(data_repo=DATA_REPO, compression=None):
+    """
+    One-shot conversion of every tournament and deck dataset in data_repo.
+    """
+    paths = glob.glob(data_repo + 'tournament_data_*.json') + [data_repo + 'tournaments.json',
+                                                                 data_repo + 'scg9272814.json']
+    return [convert(path, compression=compression) for path in paths if os.path.isfile(path)]
+
+
+def tournament_formats(data_repo=DATA_REPO):
+    """
+    The format of every tournament ID in the tournament_formats_*.json maps fetch.ml_tournament_ids
+    writes, combined.
+    """
+    formats = dict()
+    for path in sorted(glob.glob(data_repo + 'tournament_formats_*.json')):
+        with open(path) as file:
+            formats.update(json.load(file))
+    return formats
+
+
+def merge_tournaments(data_repo=DATA_REPO):
+    """
+    Combines every tournament_data_* dataset into the unified tournament_data.jsonl, one record per
+    tournament ID. Tournaments already in the unified dataset are kept, and win over the per-format
+    files, so merging again only adds the IDs it doesn't have yet. Tournaments without a format tag
+    get the format the tournament_formats_*.json maps give their ID, or the format of the file they
+    came from when that file holds a single format.
+    Raises ValueError, without writing anything, if any tournament is left untagged: the unified
+    dataset silently drops those.
+    """
+    bases = sorted({data_repo + os.path.basename(path).split('.')[0]
+                    for path in glob.glob(data_repo + 'tournament_data_*')})
+    #the unified dataset may already hold tournaments scraped straight into it, so it is read first
+    unified_path = dataset_path(data_repo + 'tournament_data')
+    if os.path.isfile(unified_path):
+        bases.insert(0, data_repo + 'tournament_data')
+    known = tournament_formats(data_repo)
+    seen, untagged = set(), list()
+
+    def tagged():
+        for base in bases:
+            formats = base[len(data_repo + 'tournament_data_'):].split('_')
+            for tournament in read_records(dataset_path(base)):
+                if str(tournament['id']) in seen:
+                    continue
+                seen.add(str(tournament['id']))
+                if not tournament.get('format'):
+                    tournament['format'] = known.get(str(tournament['id']))
+                if not tournament['format'] and len(formats) == 1:
+                    tournament['format'] = formats[0]
+                if not tournament['format']:
+                    untagged.append(str(tournament['id']))
+                yield tournament
+    write_path = data_repo + 'tournament_data.jsonl' if unified_path.endswith('.json') else unified_path
+    #written next to the target and only moved into place once every tournament is tagged
+    tmp_path = data_repo + 'tournament_data.tmp' + write_path[len(data_repo + 'tournament_data'):]
+    try:
+        count = write_records(tmp_path, tagged())
+        if untagged:
+            raise ValueError('%d tournaments have no known format (e.g. %s); run fetch.ml_tournament_ids with '
+                             'output=True for their formats to write tournament_formats_*.json, then merge again'
+                             % (len(untagged), ', '.join(untagged[:5])))
+        os.replace(tmp_path, write_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    return count
+
+
+if __name__ == '__main__':
+    print(convert_all())
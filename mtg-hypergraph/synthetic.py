@@ -0,0 +1,154 @@
+import math
+import os
+import numpy as np
+from storage import write_records
+
+DATA_REPO = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]) + '/data/'
+CARD_TYPES = ['Creature', 'Instant', 'Sorcery', 'Enchantment', 'Artifact', 'Planeswalker', 'Land']
+
+
+class CardPool(object):
+    """
+    A made-up card pool: n_cards cards with Zipf-like popularity and a hidden strength each, and
+    n_archetypes archetypes, each a core of cards its decks are mostly built from. Decks win more
+    often the stronger their cards are, so rankings computed from the data have a signal to find.
+    """
+    def __init__(self, n_cards=500, n_archetypes=None, core_size=12, seed=0):
+        self.random = np.random.RandomState(seed)
+        self.names = ['Synthetic Card %d' % i for i in range(n_cards)]
+        self.types = [CARD_TYPES[i % len(CARD_TYPES)] for i in range(n_cards)]
+        self.strength = self.random.normal(0, 1, n_cards)
+        popularity = 1/np.arange(1, n_cards + 1)
+        self.popularity = popularity/popularity.sum()
+        n_archetypes = n_archetypes or max(4, n_cards // 25)
+        core_size = min(core_size, n_cards)
+        self.archetypes = [self.random.choice(n_cards, core_size, replace=False, p=self.popularity)
+                           for _ in range(n_archetypes)]
+
+    def deck(self, main_size=(12, 30), sideboard_size=(0, 6)):
+        """
+        One deck as (archetype, card IDs, counts). Main deck and sideboard are listed one after the
+        other, so a card in both is listed twice, as on mtgo-stats.
+        """
+        archetype = self.random.randint(len(self.archetypes))
+        core = self.archetypes[archetype]
+        size = self.random.randint(main_size[0], main_size[1] + 1)
+        kept = core[self.random.rand(len(core)) < 0.8]
+        filler = self.random.choice(len(self.names), max(size - len(kept), 0), p=self.popularity)
+        main = list(dict.fromkeys(list(kept) + list(filler)))[:size]
+        sideboard_count = self.random.randint(sideboard_size[0], sideboard_size[1] + 1)
+        sideboard = list(dict.fromkeys(self.random.choice(len(self.names), sideboard_count, p=self.popularity)))
+        cards = main + sideboard
+        counts = self.random.randint(1, 5, len(cards))
+        return archetype, cards, counts
+
+    def strength_of(self, cards):
+        return self.strength[cards].mean() if len(cards) else 0.0
+
+    def listing(self, cards, counts):
+        """
+        Deck strings as ml_tournament_player_data scrapes them.
+        """
+        return ['%d %s' % (count, self.names[card]) for card, count in zip(cards, counts)]
+
+
+def match(pool, strength_a, strength_b):
+    """
+    Plays a best of three between decks of the given strengths and returns the games won by each.
+    """
+    p = 1/(1 + math.exp(strength_b - strength_a))
+    wins = losses = 0
+    while wins < 2 and losses < 2:
+        if pool.random.rand() < p:
+            wins += 1
+        else:
+            losses += 1
+    return wins, losses
+
+
+def tournament(pool, tournament_id, n_players=32, rounds=None, mtg_format=None, date='01/01/15'):
+    """
+    One tournament in the shape ml_tournament_data returns: Swiss pairings over rounds rounds
+    (ceil(log2(n_players)) by default, as fetch assumes), with a bye for the odd player out.
+    """
+    rounds = rounds or math.ceil(math.log2(max(n_players, 2)))
+    players = ['player%d_%d' % (tournament_id, i) for i in range(n_players)]
+    decks = [pool.deck() for _ in players]
+    strengths = [pool.strength_of(cards) for _, cards, _ in decks]
+    points = [0]*n_players
+    records = [[0, 0, 0] for _ in players]
+    matchups = list()
+    for _ in range(rounds):
+        order = sorted(range(n_players), key=lambda i: (-points[i], pool.random.rand()))
+        if len(order) % 2:
+            bye = order.pop()
+            matchups.append([players[bye], 'Bye', '2-0-0'])
+            points[bye] += 3
+            records[bye][0] += 1
+        for a, b in zip(order[::2], order[1::2]):
+            wins, losses = match(pool, strengths[a], strengths[b])
+            matchups.append([players[a], players[b], '%d-%d-0' % (wins, losses)])
+            won = wins > losses
+            points[a if won else b] += 3
+            records[a][0 if won else 1] += 1
+            records[b][1 if won else 0] += 1
+    data = dict(id=str(tournament_id), date=date, matchups=matchups,
+                entries=[dict(player=player, deck=pool.listing(cards, counts), record='-'.join(map(str, records[i])))
+                         for i, (player, (_, cards, counts)) in enumerate(zip(players, decks))])
+    if mtg_format is not None:
+        data['format'] = mtg_format
+    return data
+
+
+def tournament_data(n_tournaments=100, n_players=32, rounds=None, mtg_format=['constructed', 'limited'], pool=None,
+                    first_id=10000):
+    """
+    Yields n_tournaments tournaments, formats taken in turn from mtg_format.
+    """
+    pool = pool or CardPool()
+    for i in range(n_tournaments):
+        yield tournament(pool, first_id + i, n_players=n_players, rounds=rounds,
+                         mtg_format=mtg_format[i % len(mtg_format)],
+                         date='%02d/%02d/15' % (1 + i // 28 % 12, 1 + i % 28))
+
+
+def scg_decks(n_decks=2000, pool=None, event_size=64):
+    """
+    Yields n_decks decks in the shape scg_deck returns, ranked within events of event_size
+    decks by strength plus noise.
+    """
+    pool = pool or CardPool()
+    for event_start in range(0, n_decks, event_size):
+        decks = [pool.deck(sideboard_size=(0, 0)) for _ in range(min(event_size, n_decks - event_start))]
+        scores = [pool.strength_of(cards) + pool.random.normal(0, 1) for _, cards, _ in decks]
+        ranks = np.argsort(np.argsort(scores)[::-1]) + 1
+        event = 'StarCityGames.com Open Series: Synthetic %d' % (event_start // event_size)
+        for i, (archetype, cards, counts) in enumerate(decks):
+            types = dict()
+            for card, count in zip(cards, counts):
+                types[pool.types[card]] = types.get(pool.types[card], 0) + int(count)
+            yield dict(name='Archetype %d' % archetype, player='Player %d' % (event_start + i), rank=str(ranks[i]),
+                       event=event, date='2015-01-%02d' % (1 + event_start // event_size % 28),
+                       card=dict(types=sorted(types.items()),
+                                 names=[(pool.names[card], int(count)) for card, count in zip(cards, counts)]),
+                       file='scg_decks/%d/Deck.html' % (event_start + i))
+
+
+def generate(data_repo=DATA_REPO + 'synthetic/', n_cards=500, n_tournaments=100, n_players=32, rounds=None,
+             n_scg_decks=2000, mtg_format=['constructed', 'limited'], unified=False, seed=0):
+    """
+    Writes a synthetic dataset to data_repo as fetch would: tournament_data_*.jsonl (or the unified
+    tournament_data.jsonl) and scg9272814.jsonl. Returns the paths written. Kept out of DATA_REPO
+    itself by default so scraped data is never overwritten.
+    """
+    pool = CardPool(n_cards=n_cards, seed=seed)
+    base = 'tournament_data' if unified else 'tournament_data_' + '_'.join(mtg_format)
+    paths = [data_repo + base + '.jsonl', data_repo + 'scg9272814.jsonl']
+    write_records(paths[0], tournament_data(n_tournaments, n_players=n_players, rounds=rounds,
+                                            mtg_format=mtg_format, pool=pool))
+    write_records(paths[1], scg_decks(n_scg_decks, pool=pool))
+    return paths
+
+
+if __name__ == '__main__':
+    print(generate())